@@ -2,8 +2,22 @@ import tkinter as tk
 from tkinter import filedialog, messagebox, ttk, colorchooser
 import os
 import sys
-from PIL import Image, ImageTk, ImageEnhance, ImageFilter, ImageDraw, ImageFont
+import math
+import time
+import threading
+import queue
+import weakref
+import zlib
+import io
+import struct
+import sqlite3
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from PIL import Image, ImageTk, ImageFilter, ImageDraw, ImageFont
 import json
+import glob
+import xml.etree.ElementTree as ET
 
 # 获取系统字体
 try:
@@ -21,26 +35,39 @@ except ImportError:
     HAS_DND = False
     print("未安装tkinterdnd2库，拖拽功能将不可用。请运行 'pip install tkinterdnd2' 安装。")
 
+# 程序所在目录，缓存文件放在这里而不是当前工作目录
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
 
 class ScrollableImageList(tk.Frame):
-    """可滚动的图像列表框架"""
+    """可滚动的图像列表：直接在画布上绘制网格，只为视口附近的行创建画布项，PhotoImage循环复用"""
     def __init__(self, parent, app, **kwargs):
         super().__init__(parent, **kwargs)
         self.app = app
-        self.thumbnails = []  # 存储缩略图标签引用
+        self.names = []  # 每一项显示的文件名
+        self.cells = {}  # 已显示的项：序号 -> [PhotoImage, 图像项, 文字项, 边框项]
+        self._free_cells = []  # 移出视口后待复用的单元
+        self._placeholders = {}  # 状态文字 -> 占位图
+        self._refresh_pending = False
+        
+        # 网格布局参数：列数随宽度变化
+        self.columns = 1
+        self.thumbnail_size = (80, 80)
+        self.padding = 5
+        self.text_height = 16
+        self.cell_width = self.thumbnail_size[0] + self.padding * 2
+        self.cell_height = self.thumbnail_size[1] + self.text_height + self.padding * 2
         
         # 创建画布和滚动条
-        self.canvas = tk.Canvas(self, highlightthickness=0)
+        self.canvas = tk.Canvas(self, highlightthickness=0, yscrollincrement=self.cell_height // 4)
         self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.canvas.yview)
-        self.scrollable_frame = ttk.Frame(self.canvas)
-        
-        # 配置画布滚动
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
-        self.canvas_window = self.canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
+        self.canvas.configure(yscrollcommand=self.on_scroll)
+        # 缩略图底色与画布背景一致
+        self.background = tuple(value >> 8 for value in self.canvas.winfo_rgb(self.canvas.cget('background')))
         
         # 绑定事件
-        self.scrollable_frame.bind("<Configure>", self.on_frame_configure)
         self.canvas.bind("<Configure>", self.on_canvas_configure)
+        self.canvas.bind("<Button-1>", self.on_click)
         
         # 鼠标滚轮支持
         self.bind_mousewheel()
@@ -49,14 +76,10 @@ class ScrollableImageList(tk.Frame):
         self.canvas.pack(side="left", fill="both", expand=True)
         self.scrollbar.pack(side="right", fill="y")
         
-        # 网格布局参数
-        self.columns = 2  # 默认每行显示两个缩略图
-        self.thumbnail_size = (80, 80)
-        
     def bind_mousewheel(self):
         """绑定鼠标滚轮事件"""
         def _on_mousewheel(event):
-            self.canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+            self.canvas.yview_scroll(int(-1*(event.delta/120)) * 4, "units")
             
         def _bind_to_mousewheel(event):
             self.canvas.bind_all("<MouseWheel>", _on_mousewheel)
@@ -67,57 +90,131 @@ class ScrollableImageList(tk.Frame):
         self.canvas.bind('<Enter>', _bind_to_mousewheel)
         self.canvas.bind('<Leave>', _unbind_from_mousewheel)
         
-    def on_frame_configure(self, event=None):
-        """当滚动框架大小改变时更新滚动区域"""
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+    def on_scroll(self, first, last):
+        """滚动位置改变时更新滚动条和可见的单元，并让可见的缩略图优先生成"""
+        self.scrollbar.set(first, last)
+        self.schedule_refresh()
+        self.app.prioritize_thumbnails()
         
     def on_canvas_configure(self, event):
-        """当画布大小改变时调整窗口大小"""
-        canvas_width = event.width
-        self.canvas.itemconfig(self.canvas_window, width=canvas_width)
-        self.update_layout()
-        
-    def update_layout(self):
-        """更新缩略图布局"""
-        # 固定每行显示两个缩略图
-        self.columns = 2
+        """画布宽度改变时重新计算列数"""
+        columns = max(1, event.width // self.cell_width)
+        if columns != self.columns:
+            self.columns = columns
+            self.update_layout()
+        else:
+            self.schedule_refresh()
+        self.app.prioritize_thumbnails()
             
-        # 重新排列所有缩略图
-        for i, thumbnail_frame in enumerate(self.thumbnails):
-            row = i // self.columns
-            col = i % self.columns
-            thumbnail_frame.grid(row=row, column=col, padx=5, pady=5)
+    def on_click(self, event):
+        """点击单元时加载对应的图像"""
+        column = int(self.canvas.canvasx(event.x)) // self.cell_width
+        row = int(self.canvas.canvasy(event.y)) // self.cell_height
+        index = row * self.columns + column
+        if column < self.columns and 0 <= index < len(self.names):
+            self.app.load_image(index)
             
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
-        
-    def add_thumbnail(self, image_path, thumbnail_image, filename):
-        """添加缩略图到列表"""
-        index = len(self.thumbnails)
-        
-        # 创建缩略图框架
-        thumbnail_frame = ttk.Frame(self.scrollable_frame, relief="ridge", padding=2)
-        thumbnail_frame.index = index  # 保存索引
-        
-        # 创建缩略图标签
-        thumbnail_label = tk.Label(thumbnail_frame, image=thumbnail_image, bd=0)
-        thumbnail_label.pack()
+    def visible_indices(self, margin_rows=0):
+        """当前滚动位置下可见（及上下各margin_rows行）的序号"""
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first_row = max(0, int(top // self.cell_height) - margin_rows)
+        last_row = int(bottom // self.cell_height) + margin_rows
+        return range(min(len(self.names), first_row * self.columns),
+                     min(len(self.names), (last_row + 1) * self.columns))
         
-        # 创建文件名标签
-        name_label = ttk.Label(thumbnail_frame, text=filename, font=("Arial", 8))
-        name_label.pack()
-        
-        # 绑定点击事件
-        for widget in [thumbnail_frame, thumbnail_label, name_label]:
-            widget.bind("<Button-1>", lambda e, idx=index: self.app.load_image(idx))
+    def update_layout(self):
+        """列数或项数改变时更新滚动区域，所有单元重新定位"""
+        rows = math.ceil(len(self.names) / self.columns)
+        self.canvas.configure(scrollregion=(0, 0, self.columns * self.cell_width, rows * self.cell_height))
+        for index in list(self.cells):
+            self.release_cell(index)
+        self.schedule_refresh()
+        
+    def schedule_refresh(self):
+        """在空闲时刷新可见的单元（合并多次滚动事件）"""
+        if not self._refresh_pending:
+            self._refresh_pending = True
+            self.after_idle(self.refresh)
+            
+    def refresh(self):
+        """只为视口附近的行保留单元：移出的单元回收，新进入的单元从回收池中取出"""
+        self._refresh_pending = False
+        wanted = self.visible_indices(margin_rows=1)
+        for index in [index for index in self.cells if index not in wanted]:
+            self.release_cell(index)
+        for index in wanted:
+            if index not in self.cells:
+                self.show_cell(index)
+                
+    def show_cell(self, index):
+        """在网格位置index显示一项"""
+        if self._free_cells:
+            cell = self._free_cells.pop()
+        else:
+            photo = ImageTk.PhotoImage('RGB', self.thumbnail_size)
+            cell = [photo,
+                    self.canvas.create_image(0, 0, image=photo, anchor="nw"),
+                    self.canvas.create_text(0, 0, anchor="n", font=("Arial", 8)),
+                    self.canvas.create_rectangle(0, 0, 0, 0, outline="gray")]
+        x = index % self.columns * self.cell_width + self.padding
+        y = index // self.columns * self.cell_height + self.padding
+        self.canvas.coords(cell[1], x, y)
+        self.canvas.coords(cell[2], x + self.thumbnail_size[0] // 2, y + self.thumbnail_size[1] + 2)
+        self.canvas.coords(cell[3], x - 2, y - 2, x + self.thumbnail_size[0] + 2,
+                           y + self.thumbnail_size[1] + self.text_height)
+        name = self.names[index]
+        self.canvas.itemconfigure(cell[2], text=name if len(name) <= 14 else name[:12] + '…')
+        for item in cell[1:]:
+            self.canvas.itemconfigure(item, state='normal')
+        self.cells[index] = cell
+        self.draw_thumbnail(index)
+        
+    def release_cell(self, index):
+        """隐藏一项，单元放回回收池；回收池最多保留视口大小的单元，多余的删除"""
+        cell = self.cells.pop(index)
+        if len(self._free_cells) < self.columns * (self.canvas.winfo_height() // self.cell_height + 4):
+            for item in cell[1:]:
+                self.canvas.itemconfigure(item, state='hidden')
+            self._free_cells.append(cell)
+        else:
+            self.canvas.delete(*cell[1:])
             
-        self.thumbnails.append(thumbnail_frame)
+    def draw_thumbnail(self, index):
+        """把第index项的缩略图（或占位文字）居中画到它的PhotoImage中"""
+        image, text = self.app.get_list_thumbnail(index)
+        if image is not None:
+            tile = Image.new('RGB', self.thumbnail_size, self.background)
+            position = ((self.thumbnail_size[0] - image.width) // 2, (self.thumbnail_size[1] - image.height) // 2)
+            tile.paste(image, position, image if image.mode == 'RGBA' else None)
+        else:
+            tile = self._placeholders.get(text)
+            if tile is None:
+                tile = self._placeholders[text] = Image.new('RGB', self.thumbnail_size, 'lightgray')
+                draw = ImageDraw.Draw(tile)
+                draw.text((10, self.thumbnail_size[1]//2), text, fill='black')
+        self.cells[index][0].paste(tile)
+        
+    def refresh_items(self, indices):
+        """缩略图状态改变后重画仍在视口附近的项"""
+        for index in indices:
+            if index in self.cells:
+                self.draw_thumbnail(index)
+                
+    def add_items(self, names):
+        """追加多项（只记录文件名，单元在滚动到视口附近时才创建）"""
+        self.names.extend(names)
         self.update_layout()
         
     def clear(self):
-        """清空所有缩略图"""
-        for thumbnail in self.thumbnails:
-            thumbnail.destroy()
-        self.thumbnails = []
+        """清空所有项"""
+        for index in list(self.cells):
+            self.release_cell(index)
+        for cell in self._free_cells:
+            self.canvas.delete(*cell[1:])
+        self._free_cells = []
+        self.names = []
+        self.update_layout()
 
 
 class WatermarkTemplateManager:
@@ -166,7 +263,1822 @@ class WatermarkTemplateManager:
         return list(self.templates.keys())
 
 
+class WatermarkSettings:
+    """不可变的水印设置：未修改过的图像共用同一个对象，修改时生成新对象（写时复制），可以pickle传给工作进程"""
+    __slots__ = ('_values',)
+    
+    # 设置项及默认值
+    DEFAULTS = (
+        ('text', "水印文本"),
+        ('font_family', "Microsoft YaHei"),
+        ('font_size', 20),
+        ('bold', False),
+        ('italic', False),
+        ('color', "#000000"),
+        ('opacity', 50),
+        ('shadow', False),
+        ('outline', False),
+        ('outline_color', "#FFFFFF"),
+        ('position', "bottom-right"),
+        ('custom_x', 0),
+        ('custom_y', 0),
+        ('text_rotation', 0.0),  # 文字水印旋转角度
+        ('image_path', ""),
+        ('image_opacity', 50),
+        ('image_scale', 1.0),
+        ('use_image', False),
+        ('image_position', "bottom-right"),
+        ('image_custom_x', 0),
+        ('image_custom_y', 0),
+        ('image_rotation', 0.0),  # 图片水印旋转角度
+    )
+    
+    def __init__(self, values=None):
+        settings = dict(self.DEFAULTS)
+        if values:
+            # 忽略未知的设置项（例如旧版本模板中的字段）
+            settings.update((key, value) for key, value in values.items() if key in settings)
+        object.__setattr__(self, '_values', settings)
+        
+    def __setattr__(self, name, value):
+        raise AttributeError("水印设置不可修改，请使用replace()生成新的设置")
+        
+    def __reduce__(self):
+        return (WatermarkSettings, (self._values,))
+        
+    def __getitem__(self, key):
+        return self._values[key]
+        
+    def __iter__(self):
+        return iter(self._values)
+        
+    def __len__(self):
+        return len(self._values)
+        
+    def __eq__(self, other):
+        return isinstance(other, WatermarkSettings) and self._values == other._values
+        
+    def __hash__(self):
+        return hash(tuple(self._values.items()))
+        
+    def keys(self):
+        return self._values.keys()
+        
+    def items(self):
+        return self._values.items()
+        
+    def replace(self, **changes):
+        """返回修改了部分设置项的新对象，没有实际改变时返回自身"""
+        if all(self._values.get(key) == value for key, value in changes.items()):
+            return self
+        values = dict(self._values)
+        values.update(changes)
+        return WatermarkSettings(values)
+
+
+class ImageRecord:
+    """图像库中的一项：路径、文件名、水印设置和编辑状态（第一次编辑时才创建）"""
+    __slots__ = ('path', 'name', 'watermark', 'edits')
+    
+    def __init__(self, path, watermark):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.watermark = watermark
+        self.edits = None
+
+
+class ImageLibrary:
+    """导入的图像：按导入顺序保存的记录和路径到序号的索引"""
+    def __init__(self):
+        self.records = []
+        self.index = {}  # 路径 -> 序号
+        
+    def __len__(self):
+        return len(self.records)
+        
+    def __getitem__(self, index):
+        return self.records[index]
+        
+    def __iter__(self):
+        return iter(self.records)
+        
+    def __contains__(self, path):
+        return path in self.index
+        
+    def add(self, path, watermark):
+        """添加图像，路径已存在时返回None"""
+        if path in self.index:
+            return None
+        record = ImageRecord(path, watermark)
+        self.index[path] = len(self.records)
+        self.records.append(record)
+        return record
+        
+    def index_of(self, path):
+        """路径对应的序号，不在库中时返回None"""
+        return self.index.get(path)
+
+
+class LRUCache:
+    """按最近使用顺序淘汰的缓存，可限制条目数和/或字节数"""
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # 缓存可能被后台渲染线程和主线程同时访问
+        self._lock = threading.RLock()
+        
+    def __len__(self):
+        return len(self._data)
+        
+    def __contains__(self, key):
+        return key in self._data
+        
+    def get(self, key, default=None):
+        """获取缓存项，命中时将其移到最近使用的位置"""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return default
+        
+    def put(self, key, value):
+        """写入缓存项，超出预算时淘汰最久未使用的条目"""
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.current_bytes -= self._data.pop(key)[1]
+            # 单个条目超过字节预算时不缓存
+            if self.max_bytes is not None and size > self.max_bytes:
+                return value
+            self._data[key] = (value, size)
+            self.current_bytes += size
+            while self._data and ((self.max_items is not None and len(self._data) > self.max_items) or
+                                  (self.max_bytes is not None and self.current_bytes > self.max_bytes)):
+                _, (_, old_size) = self._data.popitem(last=False)
+                self.current_bytes -= old_size
+            return value
+        
+    def discard(self, key):
+        """删除缓存项"""
+        with self._lock:
+            if key in self._data:
+                self.current_bytes -= self._data.pop(key)[1]
+            
+    def discard_if(self, predicate):
+        """删除所有键满足条件的缓存项"""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                self.discard(key)
+            
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self.current_bytes = 0
+        
+    def stats(self):
+        """返回命中/未命中计数和当前占用"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'items': len(self._data), 'bytes': self.current_bytes}
+
+
+class FontCatalog:
+    """系统字体目录：后台扫描字体文件，建立 字体族/样式 → 文件路径 的索引并持久化到磁盘"""
+    FONT_EXTENSIONS = ('.ttf', '.ttc', '.otf', '.otc')
+    INDEX_VERSION = 1
+    # 各种样式组合可接受的样式名（按优先级排列）
+    STYLE_NAMES = {
+        (False, False): ('regular', 'normal', 'book', 'roman', 'medium'),
+        (True, False): ('bold',),
+        (False, True): ('italic', 'oblique'),
+        (True, True): ('bold italic', 'bold oblique'),
+    }
+    
+    def __init__(self, index_file=None):
+        self.index_file = index_file or os.path.join(APP_DIR, "font_catalog.json")
+        self.fonts = {}  # {字体族: {样式(小写): [路径, 字体索引]}}
+        self._family_names = {}  # 小写字体族 → 字体族
+        self.ready = threading.Event()
+        self._thread = None
+        
+    def start(self):
+        """在后台线程中加载或重建索引"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._build, name="font-catalog", daemon=True)
+            self._thread.start()
+            
+    def lookup(self, font_family, bold=False, italic=False):
+        """查找字体文件，返回 (路径, 字体索引, 是否为真实样式)；索引未就绪或未找到时返回None"""
+        if not self.ready.is_set():
+            return None
+        family = self._family_names.get(font_family.lower())
+        if family is None:
+            return None
+        styles = self.fonts[family]
+        for style in self.STYLE_NAMES[(bool(bold), bool(italic))]:
+            if style in styles:
+                path, face_index = styles[style]
+                return path, face_index, True
+        # 没有对应样式时退回到常规字体，由调用方模拟粗体/斜体
+        for style in self.STYLE_NAMES[(False, False)] + tuple(styles):
+            if style in styles:
+                path, face_index = styles[style]
+                return path, face_index, False
+        return None
+        
+    def families(self):
+        """返回所有已索引的字体族名称"""
+        return sorted(self.fonts, key=str.lower)
+        
+    @staticmethod
+    def font_directories():
+        """返回当前系统的字体目录（包括fontconfig配置的目录）"""
+        directories = []
+        if os.name == 'nt':
+            windir = os.environ.get('WINDIR', 'C:/Windows')
+            directories.append(os.path.join(windir, 'Fonts'))
+            local_appdata = os.environ.get('LOCALAPPDATA')
+            if local_appdata:
+                directories.append(os.path.join(local_appdata, 'Microsoft', 'Windows', 'Fonts'))
+        elif sys.platform == 'darwin':
+            directories += ['/System/Library/Fonts', '/Library/Fonts', os.path.expanduser('~/Library/Fonts')]
+        else:
+            xdg_data_home = os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share'))
+            directories += ['/usr/share/fonts', '/usr/local/share/fonts',
+                            os.path.expanduser('~/.fonts'), os.path.join(xdg_data_home, 'fonts')]
+            # 读取fontconfig配置中的<dir>条目
+            for conf_file in ['/etc/fonts/fonts.conf'] + sorted(glob.glob('/etc/fonts/conf.d/*.conf')):
+                try:
+                    for element in ET.parse(conf_file).getroot().iter('dir'):
+                        if not element.text:
+                            continue
+                        path = os.path.expanduser(element.text.strip())
+                        if element.get('prefix') == 'xdg':
+                            path = os.path.join(xdg_data_home, path)
+                        directories.append(path)
+                except (OSError, ET.ParseError):
+                    continue
+                    
+        # 去重并只保留存在的目录
+        result = []
+        for directory in directories:
+            directory = os.path.normpath(directory)
+            if directory not in result and os.path.isdir(directory):
+                result.append(directory)
+        return result
+        
+    def _directory_mtimes(self, directories):
+        """收集所有字体目录（含子目录）的修改时间，用于判断索引是否过期"""
+        mtimes = {}
+        for directory in directories:
+            for root, _, _ in os.walk(directory):
+                try:
+                    mtimes[root] = os.stat(root).st_mtime
+                except OSError:
+                    continue
+        return mtimes
+        
+    def _build(self):
+        """加载磁盘上的索引；若目录有变化则重新扫描"""
+        try:
+            mtimes = self._directory_mtimes(self.font_directories())
+            fonts = self._load_index(mtimes)
+            if fonts is None:
+                fonts = self._scan(mtimes)
+                self._save_index(mtimes, fonts)
+            self._family_names = {family.lower(): family for family in fonts}
+            self.fonts = fonts
+        except Exception as e:
+            print(f"建立字体索引失败: {e}")
+        finally:
+            self.ready.set()
+            
+    def _load_index(self, mtimes):
+        """读取持久化的索引，目录修改时间不一致时返回None"""
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == self.INDEX_VERSION and data.get('directories') == mtimes:
+                return data['fonts']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+        
+    def _save_index(self, mtimes, fonts):
+        """保存索引到磁盘"""
+        try:
+            with open(self.index_file, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.INDEX_VERSION, 'directories': mtimes, 'fonts': fonts},
+                          f, ensure_ascii=False)
+        except OSError as e:
+            print(f"保存字体索引失败: {e}")
+            
+    def _scan(self, mtimes):
+        """解析所有字体文件的字体族和样式名"""
+        fonts = {}
+        for directory in mtimes:
+            try:
+                file_names = os.listdir(directory)
+            except OSError:
+                continue
+            for file_name in file_names:
+                if not file_name.lower().endswith(self.FONT_EXTENSIONS):
+                    continue
+                path = os.path.join(directory, file_name)
+                for face_index in range(self._face_count(path)):
+                    try:
+                        family, style = ImageFont.truetype(path, 12, index=face_index).getname()
+                    except Exception:
+                        continue
+                    if family:
+                        # 同名样式保留首次出现的文件
+                        fonts.setdefault(family, {}).setdefault((style or 'regular').lower(), [path, face_index])
+        return fonts
+        
+    @staticmethod
+    def _face_count(path):
+        """返回字体文件中包含的字体数量（TTC/OTC集合可能包含多个）"""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(12)
+            if header[:4] == b'ttcf':
+                return int.from_bytes(header[8:12], 'big')
+        except OSError:
+            pass
+        return 1
+
+
+class FontResolver:
+    """字体解析器：统一查找字体文件，并缓存已加载的字体对象和文本尺寸"""
+    # 在Windows上支持中文的后备字体
+    CHINESE_FALLBACK_FONTS = [
+        "C:/Windows/Fonts/msyh.ttc",      # 微软雅黑
+        "C:/Windows/Fonts/simhei.ttf",    # 黑体
+        "C:/Windows/Fonts/simsun.ttc",    # 宋体
+        "C:/Windows/Fonts/msgothic.ttc"   # 微软正黑体
+    ]
+    
+    def __init__(self, catalog=None, max_fonts=32, max_measurements=1024):
+        # 系统字体目录（可选），就绪后通过一次字典查找定位字体文件
+        self.catalog = catalog
+        self._catalog_applied = False
+        # 字体对象缓存，键为 (字体族, 字号, 粗体, 斜体)
+        self.fonts = LRUCache(max_items=max_fonts)
+        # 文本包围盒缓存，键为 (字体族, 字号, 粗体, 斜体, 文本)
+        self.measurements = LRUCache(max_items=max_measurements)
+        # 已加载字体是否为真实样式文件，键为 (字体族, 粗体, 斜体)
+        self.native_styles = {}
+        # 实际从磁盘加载字体的次数
+        self.disk_loads = 0
+        # FreeType字体对象不是线程安全的，加载和测量时加锁
+        self.lock = threading.RLock()
+        self._measure_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1), (0, 0, 0, 0)))
+        
+    def get_font(self, font_family, font_size, bold=False, italic=False):
+        """获取字体对象，优先使用缓存"""
+        with self.lock:
+            return self._get_font(font_family, font_size, bold, italic)
+        
+    def _get_font(self, font_family, font_size, bold, italic):
+        if self.catalog is not None and not self._catalog_applied and self.catalog.ready.is_set():
+            # 字体目录就绪前按文件名猜测加载的字体可能不准确，丢弃一次
+            self._catalog_applied = True
+            self.fonts.clear()
+            self.measurements.clear()
+            self.native_styles.clear()
+        key = (font_family, font_size, bool(bold), bool(italic))
+        font_obj = self.fonts.get(key)
+        if font_obj is None:
+            font_obj = self.fonts.put(key, self._load_font(font_family, font_size, bold, italic))
+        return font_obj
+        
+    def measure_text(self, text, font_family, font_size, bold=False, italic=False):
+        """获取文本的包围盒 (left, top, right, bottom)，优先使用缓存"""
+        key = (font_family, font_size, bool(bold), bool(italic), text)
+        bbox = self.measurements.get(key)
+        if bbox is None:
+            with self.lock:
+                font_obj = self._get_font(font_family, font_size, bold, italic)
+                bbox = self.measurements.put(key, self._measure_draw.textbbox((0, 0), text, font=font_obj))
+        return bbox
+        
+    def has_native_style(self, font_family, bold=False, italic=False):
+        """实际加载的字体文件是否为该样式（否则需要模拟粗体/斜体）"""
+        if not (bold or italic):
+            return False
+        with self.lock:
+            key = (font_family, bool(bold), bool(italic))
+            if key not in self.native_styles:
+                self._load_font(font_family, 1, bold, italic)
+            return self.native_styles[key]
+        
+    def stats(self):
+        """返回字体和尺寸缓存的命中统计"""
+        return {'fonts': self.fonts.stats(), 'measurements': self.measurements.stats(),
+                'disk_loads': self.disk_loads}
+        
+    def _truetype(self, font_path, font_size, face_index=0):
+        """从磁盘加载字体并计数"""
+        self.disk_loads += 1
+        return ImageFont.truetype(font_path, font_size, index=face_index)
+        
+    def _load_font(self, font_family, font_size, bold, italic):
+        """按字体族和样式查找字体文件并加载，同时记录是否为真实样式"""
+        font_obj = None
+        style_key = (font_family, bool(bold), bool(italic))
+        self.native_styles[style_key] = False
+        # 优先使用字体目录索引
+        entry = self.catalog.lookup(font_family, bold, italic) if self.catalog is not None else None
+        if entry is not None:
+            try:
+                font_obj = self._truetype(entry[0], font_size, entry[1])
+                self.native_styles[style_key] = entry[2]
+                return font_obj
+            except Exception as e:
+                print(f"加载字体时出错: {e}")
+        try:
+            # 在Windows上尝试加载系统字体
+            if os.name == 'nt':  # Windows
+                # 构造字体文件名
+                font_filename = font_family.lower().replace(' ', '')
+                # 根据粗体和斜体设置构造字体文件名
+                if bold and italic:
+                    font_path = f"C:/Windows/Fonts/{font_filename}bi.ttf"
+                elif bold:
+                    font_path = f"C:/Windows/Fonts/{font_filename}bd.ttf"  # bd instead of b
+                elif italic:
+                    font_path = f"C:/Windows/Fonts/{font_filename}i.ttf"
+                else:
+                    font_path = f"C:/Windows/Fonts/{font_filename}.ttf"
+                    
+                if not os.path.exists(font_path):
+                    # 尝试其他可能的命名方式
+                    if bold and italic:
+                        font_path = f"C:/Windows/Fonts/{font_filename}-bolditalic.ttf"
+                    elif bold:
+                        font_path = f"C:/Windows/Fonts/{font_filename}-bold.ttf"
+                    elif italic:
+                        font_path = f"C:/Windows/Fonts/{font_filename}-italic.ttf"
+                        
+                if os.path.exists(font_path):
+                    font_obj = self._truetype(font_path, font_size)
+                    # 按样式文件名找到的字体即为真实样式
+                    self.native_styles[style_key] = bool(bold or italic)
+        except Exception as e:
+            print(f"加载字体时出错: {e}")
+            
+        # 如果上面的方法失败了，尝试使用 PIL 的默认字体处理方式
+        if font_obj is None:
+            try:
+                # 尝试使用系统字体加载
+                font_obj = self._truetype(font_family, font_size)
+            except Exception:
+                # 如果指定字体失败，尝试使用支持中文的默认字体
+                if os.name == 'nt':
+                    for font_path in self.CHINESE_FALLBACK_FONTS:
+                        if os.path.exists(font_path):
+                            try:
+                                font_obj = self._truetype(font_path, font_size)
+                                break
+                            except Exception:
+                                continue
+                                
+                # 如果还是失败，使用默认字体
+                if font_obj is None:
+                    font_obj = ImageFont.load_default()
+        return font_obj
+
+
+class WatermarkAssetCache:
+    """图片水印资源缓存：每个文件只解码一次，并缓存缩放/透明度/旋转后的结果"""
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        # 键为 (路径,) / (路径, 缩放) / (路径, 缩放, 透明度, 旋转)
+        self.images = LRUCache(max_bytes=max_bytes, sizeof=lambda image: image.width * image.height * 4)
+        self._mtimes = {}
+        self.lock = threading.RLock()
+        
+    def _check_mtime(self, path):
+        """文件修改时间变化时丢弃该文件的所有缓存"""
+        mtime = os.stat(path).st_mtime
+        if self._mtimes.get(path) != mtime:
+            self.images.discard_if(lambda key: key[0] == path)
+            self._mtimes[path] = mtime
+            
+    def get_decoded(self, path):
+        """获取解码后的RGBA原图"""
+        with self.lock:
+            return self._get_decoded(path)
+        
+    def get_scaled(self, path, scale):
+        """获取缩放后的图片"""
+        with self.lock:
+            return self._get_scaled(path, scale)
+        
+    def get_variant(self, path, scale, opacity, rotation):
+        """获取缩放、调整透明度并旋转后的图片水印"""
+        with self.lock:
+            return self._get_variant(path, scale, opacity, rotation)
+        
+    def _get_decoded(self, path):
+        self._check_mtime(path)
+        image = self.images.get((path,))
+        if image is None:
+            with Image.open(path) as source:
+                image = self.images.put((path,), source.convert("RGBA"))
+        return image
+        
+    def _get_scaled(self, path, scale):
+        if scale == 1.0:
+            return self._get_decoded(path)
+        key = (path, scale)
+        self._check_mtime(path)
+        image = self.images.get(key)
+        if image is None:
+            image = self._get_decoded(path)
+            new_width = int(image.width * scale)
+            new_height = int(image.height * scale)
+            image = self.images.put(key, image.resize((new_width, new_height), Image.LANCZOS))
+        return image
+        
+    def _get_variant(self, path, scale, opacity, rotation):
+        if opacity <= 0 and rotation == 0:
+            return self._get_scaled(path, scale)
+        key = (path, scale, opacity, rotation)
+        self._check_mtime(path)
+        image = self.images.get(key)
+        if image is None:
+            image = self._get_scaled(path, scale)
+            if opacity > 0:
+                # 调整透明度（数值越高越透明）
+                image = image.copy()
+                alpha = image.getchannel('A')
+                alpha = alpha.point([int(x * (100 - opacity) / 100) for x in range(256)])
+                image.putalpha(alpha)
+            if rotation != 0:
+                image = image.rotate(rotation, expand=1)
+            image = self.images.put(key, image)
+        return image
+
+
+class TextEffectEngine:
+    """文本特效引擎：描边、粗体和阴影都从同一张字形蒙版派生，每种特效只需处理一遍"""
+    def __init__(self, outline_ratio=0.05, bold_ratio=0.04, shadow_offset_ratio=0.1, shadow_blur_ratio=0.04,
+                 text_margin=10):
+        # 各特效宽度与字号的比例
+        self.outline_ratio = outline_ratio
+        self.bold_ratio = bold_ratio
+        self.shadow_offset_ratio = shadow_offset_ratio
+        self.shadow_blur_ratio = shadow_blur_ratio
+        self.text_margin = text_margin  # 文本框在字形四周留出的边距（原图像素），水印按文本框定位
+        
+    def effect_widths(self, font_size, scale=1.0):
+        """按原图字号计算各特效在原图中的宽度，再按scale换算为渲染图像中的像素宽度"""
+        return {
+            # 描边和粗体缩小后至少保留1像素，否则预览中看不到
+            'outline': max(1, round(max(1, round(font_size * self.outline_ratio)) * scale)),
+            'bold': max(1, round(max(1, round(font_size * self.bold_ratio)) * scale)),
+            'shadow_offset': round(max(2, round(font_size * self.shadow_offset_ratio)) * scale),
+            'shadow_blur': round(font_size * self.shadow_blur_ratio) * scale,
+            'margin': self.text_margin * scale,
+        }
+        
+    def render(self, text, font_obj, bbox, font_size, text_color,
+               outline_color=None, shadow_color=None, fake_bold=False, scale=1.0):
+        """渲染文本及其特效，返回 (RGBA图像, 文本框)；颜色均为 (r, g, b, a)，为None表示不启用
+        font_size为原图字号，font_obj和bbox是按scale缩放后的字体及文本包围盒；
+        文本框为字形包围盒加边距在图像中的 (left, top, right, bottom)，不含特效扩展的区域"""
+        widths = self.effect_widths(font_size, scale)
+        bold_width = widths['bold'] if fake_bold else 0
+        outline_width = widths['outline'] if outline_color else 0
+        reach = bold_width + outline_width
+        if shadow_color:
+            reach += widths['shadow_offset'] + 2 * widths['shadow_blur']
+        padding = math.ceil(max(widths['margin'], reach + 2))
+        
+        # 只绘制一次文本，得到字形蒙版
+        size = (bbox[2] - bbox[0] + 2 * padding, bbox[3] - bbox[1] + 2 * padding)
+        mask = Image.new('L', size, 0)
+        ImageDraw.Draw(mask).text((padding - bbox[0], padding - bbox[1]), text, font=font_obj, fill=255)
+        
+        # 粗体：对蒙版做形态学膨胀
+        if bold_width:
+            mask = self._dilate(mask, bold_width)
+            
+        # 描边：在（加粗后的）蒙版上再膨胀一次
+        silhouette = mask
+        if outline_width:
+            silhouette = self._dilate(mask, outline_width)
+            
+        sprite = Image.new('RGBA', size, (0, 0, 0, 0))
+        
+        # 阴影：平移并模糊轮廓蒙版
+        if shadow_color:
+            offset = widths['shadow_offset']
+            shadow_mask = Image.new('L', size, 0)
+            shadow_mask.paste(silhouette.crop((0, 0, size[0] - offset, size[1] - offset)), (offset, offset))
+            if widths['shadow_blur']:
+                shadow_mask = shadow_mask.filter(ImageFilter.GaussianBlur(widths['shadow_blur']))
+            self._composite_layer(sprite, shadow_mask, shadow_color)
+            
+        if outline_width:
+            self._composite_layer(sprite, silhouette, outline_color)
+        self._composite_layer(sprite, mask, text_color)
+        margin = widths['margin']
+        text_box = (padding - margin, padding - margin,
+                    padding + bbox[2] - bbox[0] + margin, padding + bbox[3] - bbox[1] + margin)
+        return sprite, text_box
+        
+    @staticmethod
+    def _dilate(mask, radius):
+        """方形膨胀：r次3x3最大值滤波等价于一次 (2r+1) 滤波，代价随半径线性增长而非平方"""
+        for _ in range(radius):
+            mask = mask.filter(ImageFilter.MaxFilter(3))
+        return mask
+        
+    @staticmethod
+    def _affine_params(width, height, skew_factor, angle):
+        """计算错切加旋转的正向仿射系数、四角变换后的位置和扩展后的画布"""
+        radians = math.radians(angle)
+        cos_a, sin_a = math.cos(radians), math.sin(radians)
+        # 正向变换：先错切 x' = x + skew * (height - y)，再绕原点逆时针旋转
+        a, b = cos_a, sin_a - skew_factor * cos_a
+        d, e = -sin_a, skew_factor * sin_a + cos_a
+        c = skew_factor * height * cos_a
+        f = -skew_factor * height * sin_a
+        corners = [(a * x + b * y + c, d * x + e * y + f)
+                   for x, y in ((0, 0), (width, 0), (width, height), (0, height))]
+        min_x = math.floor(min(x for x, _ in corners))
+        min_y = math.floor(min(y for _, y in corners))
+        new_width = math.ceil(max(x for x, _ in corners)) - min_x
+        new_height = math.ceil(max(y for _, y in corners)) - min_y
+        return (a, b, c, d, e, f), corners, (min_x, min_y, new_width, new_height)
+        
+    @classmethod
+    def transformed_outline(cls, size, skew_factor=0.0, angle=0.0, box=None):
+        """返回 skew_and_rotate 输出图像中原图内矩形box（默认为整张原图）四角的位置（多边形轮廓）"""
+        left, top, right, bottom = box if box is not None else (0, 0) + tuple(size)
+        points = [(left, top), (right, top), (right, bottom), (left, bottom)]
+        if not skew_factor and not angle:
+            return points
+        (a, b, c, d, e, f), _, (min_x, min_y, _, _) = cls._affine_params(size[0], size[1], skew_factor, angle)
+        return [(a * x + b * y + c - min_x, d * x + e * y + f - min_y) for x, y in points]
+        
+    @classmethod
+    def skew_and_rotate(cls, image, skew_factor=0.0, angle=0.0, resample=Image.NEAREST):
+        """一次仿射变换完成斜体错切和旋转（逆时针角度，扩展画布），只重采样一次"""
+        if not skew_factor and not angle:
+            return image
+        (a, b, c, d, e, f), _, (min_x, min_y, new_width, new_height) = cls._affine_params(
+            image.width, image.height, skew_factor, angle)
+        # Image.transform 需要的是输出坐标到输入坐标的逆变换
+        det = a * e - b * d
+        inv_a, inv_b, inv_d, inv_e = e / det, -b / det, -d / det, a / det
+        tx, ty = min_x - c, min_y - f
+        matrix = (inv_a, inv_b, inv_a * tx + inv_b * ty, inv_d, inv_e, inv_d * tx + inv_e * ty)
+        return image.transform((new_width, new_height), Image.AFFINE, matrix, resample=resample)
+        
+    @staticmethod
+    def _composite_layer(sprite, mask, color):
+        """用蒙版和颜色生成一个图层并叠加到sprite上"""
+        r, g, b, a = color
+        if a <= 0:
+            return
+        layer = Image.new('RGBA', sprite.size, (r, g, b, 0))
+        layer.putalpha(mask if a >= 255 else mask.point([v * a // 255 for v in range(256)]))
+        sprite.alpha_composite(layer)
+
+
+class WatermarkGeometry:
+    """已渲染水印的几何索引：各水印在预览中的精确轮廓多边形，以及图像与画布之间的坐标变换"""
+    def __init__(self):
+        self.shapes = []  # [(类型, 轮廓多边形, x, y)]，多边形相对水印图像左上角，x、y为预览中的位置
+        self.scale = 1.0  # 预览相对原图的缩放比例
+        self.offset = (0, 0)  # 预览在画布中的位置
+        
+    def publish(self, shapes, scale, offset):
+        """发布渲染得到的水印几何信息（按合成顺序，后面的在上层）"""
+        self.shapes = list(shapes)
+        self.scale = scale
+        self.offset = offset
+        
+    def move(self, kind, x, y):
+        """更新某个水印在预览中的位置（拖拽时使用）"""
+        self.shapes = [(shape_kind, outline, x, y) if shape_kind == kind else (shape_kind, outline, shape_x, shape_y)
+                       for shape_kind, outline, shape_x, shape_y in self.shapes]
+        
+    def canvas_to_image(self, x, y):
+        """画布坐标转换为原图坐标"""
+        return (x - self.offset[0]) / self.scale, (y - self.offset[1]) / self.scale
+        
+    def hit_test(self, x, y):
+        """返回画布坐标处最上层的水印类型，没有水印时返回None"""
+        preview_x, preview_y = x - self.offset[0], y - self.offset[1]
+        for kind, outline, shape_x, shape_y in reversed(self.shapes):
+            if self.point_in_polygon(preview_x - shape_x, preview_y - shape_y, outline):
+                return kind
+        return None
+        
+    @staticmethod
+    def bounds(outline):
+        """轮廓多边形的外接矩形 (left, top, width, height)，取整"""
+        left = round(min(x for x, _ in outline))
+        top = round(min(y for _, y in outline))
+        return left, top, round(max(x for x, _ in outline)) - left, round(max(y for _, y in outline)) - top
+        
+    @staticmethod
+    def point_in_polygon(x, y, polygon):
+        """射线法判断点是否在多边形内"""
+        inside = False
+        x1, y1 = polygon[-1]
+        for x2, y2 in polygon:
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+            x1, y1 = x2, y2
+        return inside
+        
+    @staticmethod
+    def rotated_outline(size, rotated_size, angle):
+        """返回 Image.rotate(angle, expand=1) 输出图像中原图四角的位置"""
+        width, height = size
+        radians = math.radians(angle)
+        cos_a, sin_a = math.cos(radians), math.sin(radians)
+        # rotate 绕中心旋转，扩展后原图中心与输出图像中心重合
+        center_x, center_y = rotated_size[0] / 2, rotated_size[1] / 2
+        outline = []
+        for x, y in ((0, 0), (width, 0), (width, height), (0, height)):
+            dx, dy = x - width / 2, y - height / 2
+            outline.append((center_x + dx * cos_a + dy * sin_a, center_y - dx * sin_a + dy * cos_a))
+        return outline
+
+
+class ImageDecoder:
+    """按需要的尺寸选择最小的解码方式：JPEG按DCT缩放解码，JPEG2000按分辨率级别解码，金字塔TIFF选择合适的缩小层"""
+    REDUCIBLE_FORMATS = ('JPEG', 'JPEG2000', 'TIFF')
+    
+    def __init__(self):
+        # 各种解码方式的使用次数
+        self.counts = {'exif_thumbnail': 0, 'draft': 0, 'reduce': 0, 'tiff_level': 0, 'full': 0}
+        # 缩略图线程池和渲染线程会同时解码
+        self._counts_lock = threading.Lock()
+        
+    def _count(self, method):
+        """记录一次解码方式"""
+        with self._counts_lock:
+            self.counts[method] += 1
+        
+    def open_thumbnail(self, path, size):
+        """生成缩略图用的小图：优先使用JPEG中内嵌的EXIF缩略图，比例不一致或尺寸不够时才缩小解码原图
+        （与预览和导出一致，不按EXIF方向旋转；内嵌缩略图与原图像素的方向相同）"""
+        thumbnail = None
+        # 只读取文件头，用完立即关闭文件
+        with Image.open(path) as source:
+            width, height = source.size
+            if source.format == 'JPEG' and source.info.get('exif'):
+                data = self._exif_thumbnail(source.info['exif'])
+                if data is not None:
+                    try:
+                        thumbnail = Image.open(io.BytesIO(data))
+                        thumbnail.load()
+                    except Exception as e:
+                        print(f"读取 {path} 的内嵌缩略图时出错: {e}")
+                        thumbnail = None
+        ratio = min(size[0] / width, size[1] / height)
+        # 有些相机的内嵌缩略图带黑边（固定为4:3），比例不一致时不能使用
+        if (thumbnail is not None and
+                abs(thumbnail.width / thumbnail.height - width / height) <= 0.02 * width / height and
+                thumbnail.width >= int(width * ratio) and thumbnail.height >= int(height * ratio)):
+            self._count('exif_thumbnail')
+            image = thumbnail
+        else:
+            image, _ = self.open(path, size, fit=True)
+        return image
+        
+    @staticmethod
+    def _exif_thumbnail(data):
+        """从EXIF数据的IFD1中取出内嵌的JPEG缩略图，没有时返回None"""
+        if data.startswith(b'Exif\x00\x00'):
+            data = data[6:]
+        if data[:2] == b'II':
+            endian = '<'
+        elif data[:2] == b'MM':
+            endian = '>'
+        else:
+            return None
+        try:
+            # IFD0之后紧跟下一个IFD（IFD1，缩略图）的偏移
+            ifd0 = struct.unpack_from(endian + 'I', data, 4)[0]
+            count = struct.unpack_from(endian + 'H', data, ifd0)[0]
+            ifd1 = struct.unpack_from(endian + 'I', data, ifd0 + 2 + count * 12)[0]
+            if not ifd1:
+                return None
+            offset = length = None
+            count = struct.unpack_from(endian + 'H', data, ifd1)[0]
+            for i in range(count):
+                tag, kind, _, value = struct.unpack_from(endian + 'HHI4s', data, ifd1 + 2 + i * 12)
+                value = struct.unpack_from(endian + ('H' if kind == 3 else 'I'), value)[0]
+                if tag == 0x0201:  # JPEGInterchangeFormat
+                    offset = value
+                elif tag == 0x0202:  # JPEGInterchangeFormatLength
+                    length = value
+        except struct.error:
+            return None
+        if offset is None or not length or offset + length > len(data):
+            return None
+        return data[offset:offset + length]
+        
+    def open(self, path, size=None, fit=False):
+        """解码不小于size的最小版本（size为None时完整解码），返回 (已解码的图像, 相对原图的缩放比例)
+        fit为True时size是保持比例缩放后要放入的范围"""
+        image = Image.open(path)
+        full_width, full_height = image.size
+        if size and fit:
+            ratio = min(size[0] / full_width, size[1] / full_height)
+            size = (max(1, int(full_width * ratio)), max(1, int(full_height * ratio)))
+        method = 'full'
+        if size and (size[0] < full_width or size[1] < full_height):
+            if image.format == 'JPEG':
+                # DCT缩放：1/2、1/4、1/8，结果不小于请求的尺寸
+                image.draft(image.mode, size)
+                method = 'draft'
+            elif image.format == 'JPEG2000':
+                reduce = 0
+                while (math.ceil(full_width / 2 ** (reduce + 1)) >= size[0] and
+                       math.ceil(full_height / 2 ** (reduce + 1)) >= size[1]):
+                    reduce += 1
+                if reduce:
+                    image.reduce = reduce
+                    method = 'reduce'
+            elif image.format == 'TIFF':
+                level = self._tiff_level(image, size)
+                if level is not None:
+                    if level is not image:
+                        # 子IFD中的缩小层已经读入内存
+                        image.close()
+                    image = level
+                    method = 'tiff_level'
+        while True:
+            try:
+                image.load()
+                break
+            except OSError:
+                image.close()
+                if method != 'reduce' or not reduce:
+                    raise
+                # 码流中的分辨率级数不够（或某些尺寸下无法按该级解码）时，逐级退回
+                reduce -= 1
+                image = Image.open(path)
+                image.reduce = reduce
+        if getattr(image, 'n_frames', 1) > 1:
+            # 多帧文件（如金字塔TIFF）load后仍保持打开以便seek，复制已解码的这一帧后关闭文件
+            decoded = image.copy()
+            image.close()
+            image = decoded
+        if image.size == (full_width, full_height):
+            method = 'full'
+        self._count(method)
+        return image, image.width / full_width
+        
+    @staticmethod
+    def _tiff_level(image, size):
+        """在多页TIFF和子IFD中选择与原图比例相同、不小于size的最小一层，没有时返回None"""
+        full_width, full_height = image.size
+        candidates = []
+        # 子IFD中的缩小层
+        get_child_images = getattr(image, 'get_child_images', None)
+        if get_child_images is not None:
+            try:
+                candidates.extend(get_child_images())
+            except Exception as e:
+                print(f"读取TIFF子图像时出错: {e}")
+        # 依次存放各层的多页TIFF
+        best_frame = None
+        for frame in range(1, getattr(image, 'n_frames', 1)):
+            image.seek(frame)
+            width, height = image.size
+            if (size[0] <= width < full_width and size[1] <= height and
+                    abs(width / height - full_width / full_height) < 0.01 and
+                    (best_frame is None or width < best_frame[1])):
+                best_frame = (frame, width)
+        image.seek(0)
+        best = None
+        for child in candidates:
+            width, height = child.size
+            if (size[0] <= width < full_width and size[1] <= height and
+                    abs(width / height - full_width / full_height) < 0.01 and
+                    (best is None or width < best.width)):
+                best = child
+        if best_frame is not None and (best is None or best_frame[1] < best.width):
+            image.seek(best_frame[0])
+            return image
+        return best
+
+
+class FilterExecutor:
+    """卷积滤镜的分块多线程执行：按行切成带重叠边的条带并行滤波后拼接，结果与整图一次滤波逐像素相同"""
+    def __init__(self, max_workers=None, min_rows=128):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.min_rows = min_rows  # 每个条带的最少行数，图像太小时直接整图滤波
+        self._executor = None
+        self._executor_lock = threading.Lock()  # 预览和导出线程可能同时首次调用apply
+        
+    @staticmethod
+    def op_filter(op, scale=1.0):
+        """返回编辑操作对应的滤镜，半径类参数按scale缩放；不是滤镜操作时返回None"""
+        if op[0] == 'filter':
+            return op[1]
+        elif op[0] == 'gaussian_blur':
+            return ImageFilter.GaussianBlur(op[1] * scale)
+        elif op[0] == 'unsharp_mask':
+            return ImageFilter.UnsharpMask(op[1] * scale, op[2], op[3])
+        return None
+        
+    @staticmethod
+    def filter_radius(image_filter):
+        """滤镜影响的邻域半径（像素），无法确定时返回None"""
+        if isinstance(image_filter, type):
+            image_filter = image_filter()
+        if isinstance(image_filter, (ImageFilter.GaussianBlur, ImageFilter.UnsharpMask, ImageFilter.BoxBlur)):
+            radius = image_filter.radius
+            if isinstance(radius, (tuple, list)):
+                radius = max(radius)
+            # 高斯模糊由三次扩展盒式模糊近似，每次的半径不超过高斯半径
+            passes = 1 if isinstance(image_filter, ImageFilter.BoxBlur) else 3
+            return passes * (math.ceil(radius) + 1)
+        if hasattr(image_filter, 'filterargs'):
+            return max(image_filter.filterargs[0]) // 2
+        if isinstance(image_filter, ImageFilter.RankFilter):
+            return image_filter.size // 2
+        return None
+        
+    def apply(self, image, image_filter):
+        """对图像应用滤镜，大图分条带在线程池中并行处理"""
+        radius = self.filter_radius(image_filter)
+        strips = min(self.max_workers, image.height // self.min_rows)
+        if radius is None or strips <= 1:
+            return image.filter(image_filter)
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        image.load()
+        width, height = image.size
+        step = math.ceil(height / strips)
+        
+        def run(top, bottom):
+            # 条带上下各多取radius行，滤波后去掉，保证拼接处与整图滤波一致
+            outer_top, outer_bottom = max(0, top - radius), min(height, bottom + radius)
+            strip = image.crop((0, outer_top, width, outer_bottom)).filter(image_filter)
+            return strip.crop((0, top - outer_top, width, bottom - outer_top))
+        
+        futures = [(top, self._executor.submit(run, top, min(height, top + step))) for top in range(0, height, step)]
+        result = None
+        for top, future in futures:
+            strip = future.result()
+            if result is None:
+                result = Image.new(strip.mode, image.size)
+            result.paste(strip, (0, top))
+        return result
+        
+    def shutdown(self):
+        """关闭线程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class ToneEngine:
+    """色调引擎：色阶、伽马、亮度、对比度和曲线合成为一张查找表，只需一次 Image.point 处理像素"""
+    # 色调参数及其默认值（默认值时不改变图像）
+    PARAMS = (('brightness', 1.0), ('contrast', 1.0), ('gamma', 1.0), ('black', 0.0), ('white', 255.0),
+              ('shadows', 0.0), ('midtones', 0.0), ('highlights', 0.0))
+    
+    def __init__(self, max_histograms=8, max_tables=32):
+        # 灰度直方图按图像缓存（弱引用，图像释放后失效），用于计算对比度中心
+        self.histograms = LRUCache(max_items=max_histograms)
+        self.tables = LRUCache(max_items=max_tables)
+        
+    @classmethod
+    def is_identity(cls, params):
+        """参数是否全部为默认值"""
+        return all(params[name] == default for name, default in cls.PARAMS)
+        
+    @staticmethod
+    def _pre_contrast(params):
+        """返回对比度之前的色调函数（色阶、伽马、亮度），输入输出为0-1"""
+        black = params['black'] / 255
+        span = max(1, params['white'] - params['black']) / 255
+        inverse_gamma = 1 / params['gamma']
+        brightness = params['brightness']
+        
+        def function(x):
+            x = min(1.0, max(0.0, (x - black) / span))
+            return min(1.0, x ** inverse_gamma * brightness)
+        return function
+        
+    @staticmethod
+    def _curve(params):
+        """返回经过阴影、中间调、高光三个控制点的单调三次曲线，全部为0时返回None"""
+        offsets = (params['shadows'], params['midtones'], params['highlights'])
+        if not any(offsets):
+            return None
+        step = 0.25
+        ys = [0.0] + [min(1.0, max(0.0, (index + 1) * step + offset / 255)) for index, offset in enumerate(offsets)] + [1.0]
+        # Fritsch-Carlson 方法计算切线，保证曲线在控制点之间不过冲
+        deltas = [(ys[index + 1] - ys[index]) / step for index in range(4)]
+        tangents = [deltas[0]] + [0.0 if deltas[index - 1] * deltas[index] <= 0 else (deltas[index - 1] + deltas[index]) / 2
+                                  for index in range(1, 4)] + [deltas[3]]
+        for index in range(4):
+            if deltas[index] == 0:
+                tangents[index] = tangents[index + 1] = 0.0
+                continue
+            a, b = tangents[index] / deltas[index], tangents[index + 1] / deltas[index]
+            if a * a + b * b > 9:
+                t = 3 / math.sqrt(a * a + b * b)
+                tangents[index], tangents[index + 1] = t * a * deltas[index], t * b * deltas[index]
+        
+        def function(x):
+            index = min(int(x / step), 3)
+            t = (x - index * step) / step
+            h00, h10 = 2 * t ** 3 - 3 * t ** 2 + 1, t ** 3 - 2 * t ** 2 + t
+            h01, h11 = -2 * t ** 3 + 3 * t ** 2, t ** 3 - t ** 2
+            y = h00 * ys[index] + h10 * step * tangents[index] + h01 * ys[index + 1] + h11 * step * tangents[index + 1]
+            return min(1.0, max(0.0, y))
+        return function
+        
+    @staticmethod
+    def to_display_mode(image):
+        """转换为预览使用的8位模式（16位灰度取高8位，而不是截断到255）"""
+        if image.mode in ('RGB', 'RGBA', 'L'):
+            return image
+        if image.mode == 'I;16':
+            return image.convert('I').point([value >> 8 for value in range(65536)], 'L')
+        return image.convert('RGBA' if 'transparency' in image.info or image.mode.endswith('A') else 'RGB')
+        
+    def get_histogram(self, image):
+        """获取图像的256级灰度直方图（16位图像按高8位统计）"""
+        key = id(image)
+        cached = self.histograms.get(key)
+        if cached is not None and cached[0]() is image:
+            return cached[1]
+        gray = self.to_display_mode(image)
+        if gray.mode != 'L':
+            gray = gray.convert('L')
+        histogram = gray.histogram()
+        self.histograms.put(key, (weakref.ref(image), histogram))
+        return histogram
+        
+    def contrast_pivot(self, image, params):
+        """对比度调整的中心：经过色阶、伽马和亮度后的平均灰度（0-1），由缓存的直方图计算"""
+        if params['contrast'] == 1.0:
+            return 0.5
+        histogram = self.get_histogram(image)
+        function = self._pre_contrast(params)
+        total = sum(histogram)
+        if not total:
+            return 0.5
+        # 与 ImageEnhance.Contrast 相同，中心取整到8位灰度
+        mean = sum(function(value / 255) * count for value, count in enumerate(histogram)) / total
+        return int(mean * 255 + 0.5) / 255
+        
+    def build_table(self, params, pivot, entries=256):
+        """生成包含entries项的查找表"""
+        key = (tuple(params[name] for name, _ in self.PARAMS), pivot, entries)
+        table = self.tables.get(key)
+        if table is None:
+            pre_contrast = self._pre_contrast(params)
+            curve = self._curve(params)
+            contrast = params['contrast']
+            top = entries - 1
+            table = []
+            for value in range(entries):
+                x = pre_contrast(value / top)
+                x = min(1.0, max(0.0, pivot + (x - pivot) * contrast))
+                if curve is not None:
+                    x = curve(x)
+                table.append(int(x * top + 0.5))
+            table = self.tables.put(key, table)
+        return table
+        
+    def apply(self, image, params, pivot=None):
+        """对图像应用色调调整；pivot为对比度中心，未给出时按本图直方图计算"""
+        if self.is_identity(params):
+            return image
+        if pivot is None:
+            pivot = self.contrast_pivot(image, params)
+        if image.mode == 'I;16':
+            # 16位图像：65536项查找表分别生成高、低字节，再合成为16位
+            table = self.build_table(params, pivot, 65536)
+            wide = image.convert('I')
+            high = wide.point([value >> 8 for value in table], 'L')
+            low = wide.point([value & 0xFF for value in table], 'L')
+            return Image.frombytes('I;16', image.size, Image.merge('LA', (low, high)).tobytes())
+        if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode.endswith('A') else 'RGB')
+        table = self.build_table(params, pivot)
+        # 透明通道保持不变
+        bands = [table if band != 'A' else list(range(256)) for band in image.getbands()]
+        return image.point([value for band in bands for value in band])
+
+
+class EditPipeline:
+    """非破坏性编辑流水线：编辑操作依次构成各个阶段，缓存每个阶段的中间结果，修改第k个阶段时只重新计算k之后的阶段"""
+    # 可以压缩保存的图像模式
+    CHECKPOINT_MODES = ('L', 'LA', 'RGB', 'RGBA', 'I;16')
+    
+    def __init__(self, apply_op, max_bytes=256 * 1024 * 1024, checkpoint_bytes=0, checkpoint_time=0.2):
+        # apply_op(图像, 操作, 缩放比例) 返回应用该操作后的新图像，半径类参数按缩放比例换算
+        self.apply_op = apply_op
+        self.source = None
+        # 键为操作前缀（到该阶段为止的全部操作），值为该阶段的结果
+        self.stages = LRUCache(max_bytes=max_bytes, sizeof=lambda image: image.width * image.height * 4)
+        # 计算耗时超过checkpoint_time秒的阶段另存一份压缩快照，内存中的结果被淘汰后从最近的快照继续计算
+        self.checkpoints = LRUCache(max_bytes=checkpoint_bytes, sizeof=lambda entry: len(entry[2]))
+        self.checkpoint_time = checkpoint_time
+        self.computed = 0
+        
+    def run(self, source, ops, scale=1.0):
+        """对source（相对原图缩放了scale倍）依次应用ops，从缓存或压缩快照中最长的相同前缀继续计算"""
+        if source is not self.source:
+            self.stages.clear()
+            self.checkpoints.clear()
+            self.source = source
+        ops = tuple(ops)
+        start, result = 0, source
+        for stage in range(len(ops), 0, -1):
+            cached = self.stages.get(ops[:stage])
+            if cached is None and ops[:stage] in self.checkpoints:
+                mode, size, data = self.checkpoints.get(ops[:stage])
+                cached = self.stages.put(ops[:stage], Image.frombytes(mode, size, zlib.decompress(data)))
+            if cached is not None:
+                start, result = stage, cached
+                break
+        for stage in range(start, len(ops)):
+            start_time = time.perf_counter()
+            result = self.stages.put(ops[:stage + 1], self.apply_op(result, ops[stage], scale))
+            self.computed += 1
+            if (self.checkpoints.max_bytes and result.mode in self.CHECKPOINT_MODES and
+                    time.perf_counter() - start_time >= self.checkpoint_time):
+                self.checkpoints.put(ops[:stage + 1], (result.mode, result.size, zlib.compress(result.tobytes(), 1)))
+        return result
+        
+    def memory(self):
+        """缓存的中间结果和压缩快照占用的字节数"""
+        return self.stages.current_bytes + self.checkpoints.current_bytes
+        
+    def stats(self):
+        """返回阶段缓存统计、压缩快照数和实际计算的阶段数"""
+        stats = self.stages.stats()
+        stats['computed'] = self.computed
+        stats['checkpoints'] = len(self.checkpoints)
+        stats['checkpoint_bytes'] = self.checkpoints.current_bytes
+        return stats
+
+
+class EditHistory:
+    """多级撤销/重做历史：只保存编辑状态记录（色调参数和操作序列），图像由编辑流水线从最近的缓存阶段重算"""
+    def __init__(self, max_steps=100):
+        self.max_steps = max_steps
+        self.undo_stack = []
+        self.redo_stack = []
+        self.last_action = None
+        
+    def record(self, state, action=None):
+        """在修改前记录当前状态；连续的同一动作（如拖动同一滑块）只记录一次"""
+        if action is not None and action == self.last_action:
+            return
+        self.undo_stack.append(state)
+        del self.undo_stack[:-self.max_steps]
+        self.redo_stack.clear()
+        self.last_action = action
+        
+    def end_action(self):
+        """结束当前的连续动作（如松开滑块），之后的修改记录为新的一步"""
+        self.last_action = None
+        
+    def undo(self, current):
+        """撤销一步，返回要恢复的状态，没有历史时返回None"""
+        if not self.undo_stack:
+            return None
+        self.redo_stack.append(current)
+        self.last_action = None
+        return self.undo_stack.pop()
+        
+    def redo(self, current):
+        """重做一步，返回要恢复的状态，没有可重做的操作时返回None"""
+        if not self.redo_stack:
+            return None
+        self.undo_stack.append(current)
+        self.last_action = None
+        return self.redo_stack.pop()
+        
+    def memory(self):
+        """历史记录占用的字节数（估算）"""
+        return sum(sys.getsizeof(tone) + sys.getsizeof(ops) for tone, ops in self.undo_stack + self.redo_stack)
+
+
+class TilePyramid:
+    """大图的多级缩略金字塔：按需逐级减半生成，切成固定大小的图块，编辑结果按图块缓存"""
+    def __init__(self, image, process, measure, tile_size=256, max_bytes=128 * 1024 * 1024, stats_size=1024,
+                 decode=None):
+        self.image = image
+        # process(图块, 编辑操作, 对比度均值, 缩放比例) 对图块应用编辑操作；measure(图像, 编辑操作, 缩放比例) 计算对比度均值
+        self.process = process
+        self.measure = measure
+        # decode(级数) 直接以该级分辨率解码图像，无法做到时返回None
+        self.decode = decode
+        self.tile_size = tile_size
+        self.stats_size = stats_size
+        self.levels = {}  # 第k级为原图缩小2^k倍
+        self.ops = None
+        self.contrast_means = None
+        self.tiles = LRUCache(max_bytes=max_bytes, sizeof=lambda tile: tile.width * tile.height * 4)
+        
+    def get_level(self, level):
+        """获取第level级图像：优先直接按该级分辨率解码，否则由已有的更高一级减半生成，只在需要原始分辨率时完整解码"""
+        if level not in self.levels and self.decode is not None:
+            decoded = self.decode(level)
+            if decoded is not None:
+                # 解码器可能只能做到更高的一级（如JPEG最多缩小8倍），按实际尺寸归入对应的一级
+                width, height = self.image.size
+                for k in range(level, -1, -1):
+                    if decoded.size == (math.ceil(width / 2 ** k), math.ceil(height / 2 ** k)):
+                        self.levels[k] = decoded
+                        break
+        if level not in self.levels:
+            if level:
+                parent = max((k for k in self.levels if k < level), default=level - 1)
+                image = self.get_level(parent)
+                while parent < level:
+                    image = image.reduce(2)
+                    parent += 1
+                self.levels[level] = image
+            else:
+                self.image.load()
+                self.levels[0] = ToneEngine.to_display_mode(self.image)
+        return self.levels[level]
+        
+    def level_for_scale(self, scale):
+        """选择分辨率不低于显示比例的最小一级"""
+        level = 0
+        width, height = self.image.size
+        while scale <= 0.5 ** (level + 1) and min(width, height) >> (level + 1) > 0:
+            level += 1
+        return level
+        
+    def set_ops(self, ops):
+        """编辑操作改变时，丢弃按旧操作生成的图块"""
+        if ops == self.ops:
+            return
+        self.ops = ops
+        self.contrast_means = None
+        self.tiles.discard_if(lambda key: key[3] != ops)
+        
+    def get_contrast_means(self):
+        """在较小的一级上统计对比度调整所需的均值，所有图块共用，避免图块之间出现色差"""
+        if self.contrast_means is None:
+            level = self.level_for_scale(self.stats_size / max(self.image.size))
+            source = self.get_level(level)
+            self.contrast_means = self.measure(source, self.ops, source.width / self.image.width)
+        return self.contrast_means
+        
+    def get_tile(self, level, column, row):
+        """获取应用了编辑操作的图块"""
+        key = (level, column, row, self.ops)
+        tile = self.tiles.get(key)
+        if tile is None:
+            source = self.get_level(level)
+            size = self.tile_size
+            box = (column * size, row * size,
+                   min((column + 1) * size, source.width), min((row + 1) * size, source.height))
+            # 卷积滤镜需要图块周围的像素，多裁一圈再去掉，保证图块拼接处与整图处理一致
+            scale = source.width / self.image.width
+            halo = sum(FilterExecutor.filter_radius(FilterExecutor.op_filter(op, scale)) or 0
+                       for op in self.ops if FilterExecutor.op_filter(op) is not None)
+            outer = (max(0, box[0] - halo), max(0, box[1] - halo),
+                     min(source.width, box[2] + halo), min(source.height, box[3] + halo))
+            tile = self.process(source.crop(outer), self.ops, self.get_contrast_means(), scale)
+            if outer != box:
+                tile = tile.crop((box[0] - outer[0], box[1] - outer[1], box[2] - outer[0], box[3] - outer[1]))
+            tile = self.tiles.put(key, tile)
+        return tile
+        
+    def render(self, scale, box, ops):
+        """渲染按scale缩放后的整图中box区域的图像，只处理可见的图块"""
+        self.set_ops(ops)
+        level = self.level_for_scale(scale)
+        source = self.get_level(level)
+        # 显示坐标到该级图像坐标的比例
+        factor_x = source.width / (self.image.width * scale)
+        factor_y = source.height / (self.image.height * scale)
+        left, top, right, bottom = box
+        source_box = (left * factor_x, top * factor_y,
+                      min(right * factor_x, source.width), min(bottom * factor_y, source.height))
+        
+        # 拼接覆盖可见区域的图块
+        size = self.tile_size
+        first_column, first_row = int(source_box[0]) // size, int(source_box[1]) // size
+        last_column = (math.ceil(source_box[2]) - 1) // size
+        last_row = (math.ceil(source_box[3]) - 1) // size
+        region = None
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                tile = self.get_tile(level, column, row)
+                if region is None:
+                    region = Image.new(tile.mode, ((last_column - first_column + 1) * size,
+                                                   (last_row - first_row + 1) * size))
+                region.paste(tile, ((column - first_column) * size, (row - first_row) * size))
+        
+        # 缩放到显示尺寸：缩小时双线性插值，放大时保持像素清晰
+        origin_x, origin_y = first_column * size, first_row * size
+        resample = Image.NEAREST if factor_x <= 1 else Image.BILINEAR
+        return region.resize((right - left, bottom - top), resample,
+                             box=(source_box[0] - origin_x, source_box[1] - origin_y,
+                                  source_box[2] - origin_x, source_box[3] - origin_y))
+        
+    def stats(self):
+        """返回图块缓存统计和已生成的级数"""
+        stats = self.tiles.stats()
+        stats['levels'] = len(self.levels)
+        return stats
+
+
+class RenderScheduler:
+    """渲染调度器：把多次渲染请求合并为每个空闲周期最多一次渲染"""
+    def __init__(self, widget, render_func, frame_budget_ms=16):
+        self.widget = widget
+        self.render_func = render_func
+        self.frame_budget_ms = frame_budget_ms  # 两次渲染之间的最小间隔
+        self._pending = None
+        self._last_render = 0.0
+        self.requested = 0  # 收到的渲染请求数
+        self.executed = 0  # 实际执行的渲染数
+        
+    def request(self, *args):
+        """标记画面需要刷新；已有待执行的渲染时直接合并"""
+        self.requested += 1
+        if self._pending is not None:
+            return
+        elapsed_ms = (time.perf_counter() - self._last_render) * 1000
+        if elapsed_ms >= self.frame_budget_ms:
+            self._pending = self.widget.after_idle(self._run)
+        else:
+            # 距上一帧太近，等到帧间隔结束再渲染
+            self._pending = self.widget.after(int(self.frame_budget_ms - elapsed_ms) + 1, self._run)
+            
+    def _run(self):
+        self._pending = None
+        self._last_render = time.perf_counter()
+        self.executed += 1
+        self.render_func()
+        
+    def stats(self):
+        """返回请求数、执行数以及是否有待执行的渲染"""
+        return {'requested': self.requested, 'executed': self.executed,
+                'pending': self._pending is not None}
+
+
+class RenderWorker:
+    """后台渲染线程：任务带有代号，只把最新一次的渲染结果送回Tk主循环"""
+    def __init__(self, widget, on_result, poll_ms=15):
+        self.widget = widget
+        self.on_result = on_result
+        self.poll_ms = poll_ms
+        # 单个工作线程：新任务总是取代旧任务，不需要并行
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+        self.results = queue.Queue()
+        self.generation = 0
+        self._future = None
+        self._polling = False
+        self.completed = 0  # 送回主线程的结果数
+        self.discarded = 0  # 因过期被丢弃的结果数
+        self.cancelled = 0  # 开始执行前被取消的任务数
+        
+    def submit(self, func, *args):
+        """提交渲染任务，尚未开始的旧任务会被取消"""
+        self.generation += 1
+        if self._future is not None and self._future.cancel():
+            self.cancelled += 1
+        self._future = self.executor.submit(self._run, self.generation, func, args)
+        if not self._polling:
+            self._polling = True
+            self.widget.after(self.poll_ms, self._poll)
+        return self.generation
+        
+    def _run(self, generation, func, args):
+        """在工作线程中执行任务"""
+        if generation != self.generation:
+            # 已有更新的任务，跳过
+            self.results.put((generation, None, None))
+            return
+        try:
+            self.results.put((generation, func(*args), None))
+        except Exception as e:
+            self.results.put((generation, None, e))
+            
+    def _poll(self):
+        """在主线程中取回结果，只处理最新代号的结果"""
+        while True:
+            try:
+                generation, result, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation:
+                self.discarded += 1
+                continue
+            self.completed += 1
+            self.on_result(result, error)
+        if self._future is not None and self._future.done() and self.results.empty():
+            self._polling = False
+        else:
+            self.widget.after(self.poll_ms, self._poll)
+            
+    def shutdown(self):
+        """停止工作线程，丢弃未开始的任务"""
+        self.generation += 1
+        if self._future is not None:
+            self._future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class FolderScanner:
+    """递归扫描图像文件：基于os.scandir逐个目录流式产出，可限制深度、按通配符包含/排除、选择是否跟随目录的符号链接"""
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.tif', '.jp2', '.webp')
+    # 文件头特征（扩展名缺失或错误时识别图像）
+    SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'II*\x00', b'MM\x00*',
+                  b'\x00\x00\x00\x0cjP  \r\n\x87\n', b'\xff\x4f\xff\x51')
+    
+    def __init__(self, max_depth=None, include=(), exclude=('.*',), follow_symlinks=False, sniff=True,
+                 batch_size=64, batch_interval=0.2):
+        self.max_depth = max_depth  # 最大递归深度，None表示不限制，0表示只扫描所选文件夹本身
+        self.include = include  # 文件名需匹配其中之一（为空时不限制）
+        self.exclude = exclude  # 匹配文件名/目录名或相对路径的项被跳过（默认跳过隐藏文件）
+        self.follow_symlinks = follow_symlinks  # 是否进入符号链接指向的目录
+        self.sniff = sniff  # 是否读取文件头识别没有图像扩展名的文件
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval  # 找到的图像最多等待这么久就先送出
+        
+    @staticmethod
+    def _matches(name, patterns):
+        """名称是否匹配任一通配符（不区分大小写）"""
+        name = name.lower()
+        return any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in patterns)
+        
+    def is_image(self, path, name):
+        """按扩展名判断是否为图像，扩展名不符时读取文件头识别"""
+        if name.lower().endswith(self.IMAGE_EXTENSIONS):
+            return True
+        if not self.sniff:
+            return False
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(16)
+        except OSError:
+            return False
+        return (header.startswith(self.SIGNATURES) or
+                (header[:4] == b'RIFF' and header[8:12] == b'WEBP') or
+                # BMP只有两个字节的标记，再检查文件头中必须为0的保留字段
+                (header[:2] == b'BM' and len(header) >= 14 and header[6:10] == b'\x00' * 4))
+        
+    def scan(self, roots, cancel=None):
+        """依次扫描roots中的文件和文件夹，逐批产出图像路径；cancel（threading.Event）被设置时停止"""
+        batch = []
+        last_yield = time.monotonic()
+        for root in roots:
+            if cancel is not None and cancel.is_set():
+                return
+            if not os.path.isdir(root):
+                # 直接选择的文件只检查是否为图像
+                if os.path.isfile(root) and self.is_image(root, os.path.basename(root)):
+                    batch.append(root)
+                continue
+            visited = set()  # 跟随符号链接时避免目录循环
+            stack = [(root, '', 0)]
+            while stack:
+                if cancel is not None and cancel.is_set():
+                    return
+                directory, relative, depth = stack.pop()
+                try:
+                    if self.follow_symlinks:
+                        stat = os.stat(directory)
+                        if (stat.st_dev, stat.st_ino) in visited:
+                            continue
+                        visited.add((stat.st_dev, stat.st_ino))
+                    iterator = os.scandir(directory)
+                except OSError as e:
+                    print(f"无法读取文件夹 {directory}: {e}")
+                    continue
+                # 直接遍历目录项，找到的图像立即送出，不必先读完整个目录
+                subdirectories = []
+                with iterator:
+                    for entry in iterator:
+                        if cancel is not None and cancel.is_set():
+                            return
+                        path = relative + entry.name
+                        if self.exclude and (self._matches(entry.name, self.exclude) or
+                                             self._matches(path, self.exclude)):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                                if self.max_depth is None or depth < self.max_depth:
+                                    subdirectories.append((entry.path, path + '/', depth + 1))
+                            elif entry.is_file():
+                                if ((not self.include or self._matches(entry.name, self.include)) and
+                                        self.is_image(entry.path, entry.name)):
+                                    batch.append(entry.path)
+                        except OSError:
+                            continue
+                        # 边扫描边送出，大目录树中的图像不必等到扫描结束才显示
+                        if batch and (len(batch) >= self.batch_size or
+                                      time.monotonic() - last_yield >= self.batch_interval):
+                            yield batch
+                            batch = []
+                            last_yield = time.monotonic()
+                # 只对子目录排序，按名称顺序扫描
+                subdirectories.sort(key=lambda item: item[1].lower(), reverse=True)
+                stack.extend(subdirectories)
+        if batch:
+            yield batch
+
+
+class ThumbnailStore:
+    """持久化的缩略图缓存：SQLite文件，按 (绝对路径, 文件大小, 修改时间, 缩略图尺寸) 存放编码后的缩略图，超出容量时淘汰最久未用的"""
+    # 最近使用时间的更新间隔（秒），避免每次读取都写数据库
+    TOUCH_INTERVAL = 3600
+    # 缩略图生成方式改变时加1，数据库中版本不同的旧缩略图整体丢弃
+    VERSION = 2
+    
+    def __init__(self, db_file=None, max_bytes=256 * 1024 * 1024):
+        self.db_file = db_file or os.path.join(APP_DIR, "thumbnail_cache.db")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()  # 每个线程使用自己的连接
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        try:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if connection.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+                    connection.execute("DROP TABLE IF EXISTS thumbnails")
+                    connection.execute(f"PRAGMA user_version={self.VERSION}")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS thumbnails ("
+                    "path TEXT, file_size INTEGER, mtime INTEGER, width INTEGER, height INTEGER, "
+                    "data BLOB, bytes INTEGER, last_used REAL, "
+                    "PRIMARY KEY (path, file_size, mtime, width, height))")
+                connection.execute("CREATE INDEX IF NOT EXISTS thumbnails_last_used ON thumbnails (last_used)")
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            print(f"打开缩略图缓存失败: {e}")
+            
+    def _connect(self):
+        """当前线程的数据库连接，多个线程或进程可以同时写入"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # 自动提交；WAL模式下读写互不阻塞，写冲突时等待而不是立即失败
+            connection = sqlite3.connect(self.db_file, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+        
+    @staticmethod
+    def key(path, size):
+        """缓存键：源文件改变（大小或修改时间不同）后键也随之改变"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return (path, stat.st_size, stat.st_mtime_ns, size[0], size[1])
+        
+    def get(self, key):
+        """读取缓存的缩略图，不存在时返回None"""
+        try:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT data, last_used FROM thumbnails "
+                "WHERE path=? AND file_size=? AND mtime=? AND width=? AND height=?", key).fetchone()
+            if row is None:
+                self._count(False)
+                return None
+            now = time.time()
+            if now - row[1] > self.TOUCH_INTERVAL:
+                connection.execute(
+                    "UPDATE thumbnails SET last_used=? "
+                    "WHERE path=? AND file_size=? AND mtime=? AND width=? AND height=?", (now,) + key)
+            image = Image.open(io.BytesIO(row[0]))
+            image.load()
+            self._count(True)
+            return image
+        except (sqlite3.Error, OSError) as e:
+            print(f"读取缩略图缓存失败: {e}")
+            self._count(False)
+            return None
+            
+    def _count(self, hit):
+        """记录一次命中或未命中，缩略图由多个工作线程同时读取"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            
+    def put(self, key, image):
+        """保存缩略图（PNG编码），同时删除同一文件旧版本的缩略图"""
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG')
+        data = buffer.getvalue()
+        try:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("DELETE FROM thumbnails WHERE path=? AND width=? AND height=?",
+                                   (key[0], key[3], key[4]))
+                connection.execute("INSERT INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   key + (sqlite3.Binary(data), len(data), time.time()))
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+            with self._lock:
+                if self._total_bytes is not None:
+                    self._total_bytes += len(data)
+                over = self._total_bytes is None or self._total_bytes > self.max_bytes
+            if over:
+                self.evict()
+        except sqlite3.Error as e:
+            print(f"写入缩略图缓存失败: {e}")
+            
+    def evict(self):
+        """总大小超出容量时，删除最久未用的缩略图直到降到容量的90%"""
+        connection = self._connect()
+        total = connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM thumbnails").fetchone()[0]
+        if total > self.max_bytes:
+            target = total - self.max_bytes * 9 // 10
+            freed = 0
+            victims = []
+            cursor = connection.execute(
+                "SELECT path, file_size, mtime, width, height, bytes FROM thumbnails ORDER BY last_used")
+            for row in cursor:
+                if freed >= target:
+                    break
+                victims.append(row[:5])
+                freed += row[5]
+            cursor.close()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(
+                    "DELETE FROM thumbnails WHERE path=? AND file_size=? AND mtime=? AND width=? AND height=?",
+                    victims)
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+            total -= freed
+        # 其他进程也可能写入，这里记录的总大小只是估计值，超出容量时会重新统计
+        with self._lock:
+            self._total_bytes = total
+            
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class ThumbnailLoader:
+    """缩略图后台生成：多个工作线程按顺序取任务（可见项优先），结果分批送回Tk主循环"""
+    def __init__(self, widget, load, on_batch, on_progress=None, max_workers=None, batch_size=32, poll_ms=50):
+        self.widget = widget
+        self.load = load  # load(路径) 在工作线程中生成缩略图（PIL图像），失败时抛出异常
+        self.on_batch = on_batch  # on_batch([(键, 图像, 错误), ...]) 在主线程中接收一批结果
+        self.on_progress = on_progress  # on_progress(已完成数, 总数)
+        self.batch_size = batch_size
+        self.poll_ms = poll_ms
+        # 解码和缩放在C代码中执行时会释放GIL，多个线程可以并行
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or min(4, os.cpu_count() or 1),
+                                           thread_name_prefix="thumbnail")
+        self.results = queue.Queue()
+        self._pending = OrderedDict()  # 尚未开始的任务：键 -> 路径
+        self._priority = ()  # 当前可见的键，优先生成
+        self._lock = threading.Lock()
+        self._polling = False
+        self.generation = 0
+        self.total = 0  # 本轮导入的任务数
+        self.done = 0  # 本轮已送回主线程的结果数
+        self.failed = 0  # 生成失败的总数
+        
+    def submit(self, items):
+        """提交 (键, 路径) 任务，按提交顺序生成"""
+        added = 0
+        with self._lock:
+            for key, path in items:
+                if key not in self._pending:
+                    added += 1
+                self._pending[key] = path
+            self.total += added
+        if not added:
+            return
+        for _ in range(added):
+            self.executor.submit(self._run, self.generation)
+        self._report()
+        if not self._polling:
+            self._polling = True
+            self.widget.after(self.poll_ms, self._poll)
+            
+    def prioritize(self, keys):
+        """设置当前可见的键，这些任务会被优先生成"""
+        self._priority = tuple(keys)
+        
+    def _next(self):
+        """取出下一个任务：可见项优先，其次按提交顺序"""
+        with self._lock:
+            for key in self._priority:
+                if key in self._pending:
+                    return key, self._pending.pop(key)
+            if self._pending:
+                return self._pending.popitem(last=False)
+            return None
+            
+    def _run(self, generation):
+        """在工作线程中生成一张缩略图"""
+        if generation != self.generation:
+            return
+        task = self._next()
+        if task is None:
+            return
+        key, path = task
+        try:
+            self.results.put((generation, key, self.load(path), None))
+        except Exception as e:
+            self.results.put((generation, key, None, e))
+            
+    def _poll(self):
+        """在主线程中分批取回结果，每次最多batch_size个，避免长时间阻塞界面"""
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                generation, key, image, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation:
+                continue
+            if error is not None:
+                self.failed += 1
+            batch.append((key, image, error))
+        if batch:
+            self.done += len(batch)
+            self.on_batch(batch)
+            self._report()
+        if self.done >= self.total:
+            self._polling = False
+        else:
+            # 还有已完成的结果（例如大量缓存命中）时尽快处理下一批，让出主循环处理界面事件即可
+            self.widget.after(1 if not self.results.empty() else self.poll_ms, self._poll)
+            
+    def _report(self):
+        """通知进度"""
+        if self.on_progress is not None:
+            self.on_progress(self.done, self.total)
+        if self.done >= self.total:
+            # 本轮全部完成，下次导入重新计数
+            self.done = self.total = 0
+            
+    def cancel(self):
+        """取消尚未完成的任务，正在生成的结果也会被丢弃"""
+        with self._lock:
+            self._pending.clear()
+            self.generation += 1
+        self.done = self.total
+        self._report()
+        
+    def shutdown(self):
+        """停止工作线程，丢弃未开始的任务"""
+        with self._lock:
+            self._pending.clear()
+            self.generation += 1
+        self.executor.shutdown(wait=False)
+
+
 class ImageProcessorApp:
+    # 影响文本水印渲染结果的设置项（作为文本水印缓存的键）
+    TEXT_SPRITE_KEYS = ('text', 'font_family', 'font_size', 'bold', 'italic', 'color', 'opacity',
+                        'shadow', 'outline', 'outline_color', 'text_rotation')
+    # 全分辨率编辑结果的缓存预算（其中四分之一用于压缩快照）
+    EDIT_CACHE_BUDGET = 512 * 1024 * 1024
+    # 预览最大放大倍数和每次滚轮缩放的倍数
+    MAX_ZOOM = 8.0
+    ZOOM_STEP = 1.25
+    # 水印的最大渲染比例：放大查看时按原图分辨率渲染水印再放大，渲染代价不随缩放倍数增长
+    MAX_SPRITE_SCALE = 1.0
+    
     def __init__(self, root):
         self.root = root
         self.root.title("图像处理工具")
@@ -175,48 +2087,100 @@ class ImageProcessorApp:
         
         # 变量
         self.original_image = None
-        self.processed_image = None
-        self.display_image = None
+        self.tone_engine = ToneEngine()  # 色调调整（合成为一张查找表）
+        self.filter_executor = FilterExecutor()  # 大图滤镜分条带多线程执行
+        self.export_pipeline = EditPipeline(self.apply_edit_op, max_bytes=self.EDIT_CACHE_BUDGET * 3 // 4,
+                                            checkpoint_bytes=self.EDIT_CACHE_BUDGET // 4)  # 全分辨率编辑流水线（导出时使用）
+        self._restoring_edits = False  # 恢复历史状态时不再记录历史
+        self.tone_dialog_vars = None  # 打开的色调对话框的滑块变量，切换图像或撤回时同步
+        self.image_decoder = ImageDecoder()  # 预览和缩略图按需要的尺寸缩小解码，只有导出时完整解码
+        self.image_lock = threading.Lock()  # 原图可能同时被后台渲染线程读取
+        self.preview_source = None  # (原图, 尺寸, 原图代理, 缩放比例)，只在渲染线程中访问
+        self.preview_size = (0, 0)  # 预览在画布中的尺寸
+        self.watermark_geometry = WatermarkGeometry()  # 渲染时发布的水印几何信息，用于点击检测
+        self.preview_pipeline = EditPipeline(self.apply_edit_op, max_bytes=64 * 1024 * 1024)  # 预览代理的编辑流水线，只在渲染线程中访问
+        self.preview_pyramid = None  # 放大查看时使用的图块金字塔，只在渲染线程中访问
+        self.view_zoom = None  # 预览缩放比例，None表示适应画布
+        self.view_center = (0, 0)  # 放大查看时画布中心对应的原图坐标
+        self.pan_data = None  # 平移时的 (鼠标x, 鼠标y, 起始中心)
+        self.display_image = None  # 当前预览使用的PhotoImage
+        self.preview_photos = LRUCache(max_items=2)  # 按 (模式, 尺寸) 复用的PhotoImage，原地更新像素
+        self.preview_item = None  # 画布上持续使用的预览图像项
+        self.preview_timing = {'frames': 0, 'render_ms': 0.0, 'transfer_ms': 0.0}  # 最近一帧的Pillow处理和Tk传输耗时
         self.file_path = None
-        self.image_list = []  # 存储导入的图像列表
+        self.image_library = ImageLibrary()  # 导入的图像
         self.current_image_index = -1  # 当前显示的图像索引
         self.thumbnail_size = (80, 80)  # 缩略图大小
-        self.redo_image = None  # 用于重做操作的图像
-        
-        # 默认水印变量
-        self.default_watermark_vars = {
-            'text': tk.StringVar(value="水印文本"),
-            'font_family': tk.StringVar(value="Microsoft YaHei"),
-            'font_size': tk.IntVar(value=20),
-            'bold': tk.BooleanVar(value=False),
-            'italic': tk.BooleanVar(value=False),
-            'color': tk.StringVar(value="#000000"),
-            'opacity': tk.IntVar(value=50),
-            'shadow': tk.BooleanVar(value=False),
-            'outline': tk.BooleanVar(value=False),
-            'outline_color': tk.StringVar(value="#FFFFFF"),
-            'position': tk.StringVar(value="bottom-right"),
-            'custom_x': tk.IntVar(value=0),
-            'custom_y': tk.IntVar(value=0),
-            'text_rotation': tk.DoubleVar(value=0.0),  # 文字水印旋转角度
-            'image_path': tk.StringVar(value=""),
-            'image_opacity': tk.IntVar(value=50),
-            'image_scale': tk.DoubleVar(value=1.0),
-            'use_image': tk.BooleanVar(value=False),
-            'image_position': tk.StringVar(value="bottom-right"),
-            'image_custom_x': tk.IntVar(value=0),
-            'image_custom_y': tk.IntVar(value=0),
-            'image_rotation': tk.DoubleVar(value=0.0)  # 图片水印旋转角度
-        }
+        
+        # 水印变量只绑定当前编辑的图像，修改时写回该图像的水印设置（写时复制）
+        self.default_watermark = WatermarkSettings()  # 新导入的图像共用的默认设置
+        self.watermark_vars = {}
+        for key, value in WatermarkSettings.DEFAULTS:
+            if isinstance(value, bool):
+                var = tk.BooleanVar(value=value)
+            elif isinstance(value, int):
+                var = tk.IntVar(value=value)
+            elif isinstance(value, float):
+                var = tk.DoubleVar(value=value)
+            else:
+                var = tk.StringVar(value=value)
+            var.trace_add('write', lambda *args, key=key: self.on_watermark_var_changed(key))
+            self.watermark_vars[key] = var
+        self._binding_watermark = False  # 切换图像时设置变量，不写回
         
         # 水印拖拽相关变量
-        self.watermark_drag_data = {"x": 0, "y": 0, "dragging": False}
+        self.watermark_drag_data = {"x": 0, "y": 0, "dragging": False, "type": None, "sprite_item": None}
+        self.drag_sprite_photo = None
         
         # 水印模板管理器
         self.template_manager = WatermarkTemplateManager(self)
         
+        # 系统字体目录（后台线程建立索引，不阻塞启动）
+        self.font_catalog = FontCatalog()
+        self.font_catalog.start()
+        
+        # 字体解析器（预览和导出共用的字体缓存）
+        self.font_resolver = FontResolver(self.font_catalog)
+        
+        # 渲染好的文本水印缓存（按渲染参数缓存，限制总字节数）
+        self.text_sprite_cache = LRUCache(max_bytes=64 * 1024 * 1024,
+                                          sizeof=lambda entry: entry[0].width * entry[0].height * 4)
+        
+        # 文本特效引擎（描边、粗体、阴影）
+        self.text_effects = TextEffectEngine()
+        self._sprite_lock = threading.Lock()
+        
+        # 图片水印资源缓存（解码结果和变换结果）
+        self.watermark_assets = WatermarkAssetCache()
+        
+        # 列表中的缩略图：生成好的缩略图按路径缓存（限制总字节数，被淘汰的滚动回来时从磁盘缓存重新读取），
+        # 尚未生成或生成失败的记录状态文字
+        self.thumbnail_images = LRUCache(max_bytes=64 * 1024 * 1024,
+                                         sizeof=lambda image: image.width * image.height * len(image.getbands()))
+        self.thumbnail_status = {}
+        
         self.create_widgets()
         
+        # 文件夹在后台线程中递归扫描，找到的图像分批导入（扫描选项在“导入设置”中修改）
+        self.folder_scanner = FolderScanner()
+        self.scans = []  # 正在进行的扫描：{'cancel': 停止事件, 'found': 已找到的图像数}
+        self.thumbnail_progress = (0, 0)  # 缩略图 (已完成数, 总数)
+        
+        # 缩略图在后台线程中生成（先查磁盘缓存），分批送回主线程显示
+        self.thumbnail_store = ThumbnailStore()
+        self.thumbnail_loader = ThumbnailLoader(self.root, self.make_thumbnail, self.on_thumbnails_loaded,
+                                                self.on_thumbnail_progress)
+        
+        # 后台渲染线程（主线程只负责提交任务和显示结果）
+        self.render_worker = RenderWorker(self.root, self.show_rendered_preview)
+        
+        # 渲染调度器（合并滑块、变量跟踪和拖拽产生的渲染请求）
+        self.render_scheduler = RenderScheduler(self.root, self.display_image_on_canvas)
+        
+    def request_render(self, *args):
+        """请求刷新预览（合并到下一个空闲周期执行）"""
+        self.render_scheduler.request()
+        
     def create_widgets(self):
         # 创建菜单栏
         menubar = tk.Menu(self.root)
@@ -228,6 +2192,7 @@ class ImageProcessorApp:
         file_menu.add_command(label="打开图像", command=self.open_image)
         file_menu.add_command(label="批量导入", command=self.import_images)
         file_menu.add_command(label="导入文件夹", command=self.import_folder)
+        file_menu.add_command(label="导入设置", command=self.show_import_settings)
         file_menu.add_command(label="保存", command=self.export_image)  # 修复：将 save_image 改为 export_image
         file_menu.add_separator()
         file_menu.add_command(label="退出", command=self.root.quit)
@@ -235,13 +2200,27 @@ class ImageProcessorApp:
         # 编辑菜单
         edit_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="编辑", menu=edit_menu)
+        edit_menu.add_command(label="撤回", command=self.undo_edit, accelerator="Ctrl+Z")
+        edit_menu.add_command(label="重做", command=self.redo_edit, accelerator="Ctrl+Y")
+        edit_menu.add_command(label="色调调整", command=self.show_tone_settings)
         edit_menu.add_command(label="重置", command=self.reset_image)
         
+        # 视图菜单
+        view_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="视图", menu=view_menu)
+        view_menu.add_command(label="放大", command=lambda: self.zoom_view(self.ZOOM_STEP))
+        view_menu.add_command(label="缩小", command=lambda: self.zoom_view(1 / self.ZOOM_STEP))
+        view_menu.add_command(label="实际大小", command=lambda: self.zoom_view(None, absolute=1.0))
+        view_menu.add_command(label="适应窗口", command=self.fit_view)
+        
         # 水印菜单
         watermark_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="水印", menu=watermark_menu)
         watermark_menu.add_command(label="水印设置", command=self.show_watermark_settings)
         
+        self.root.bind("<Control-z>", lambda event: self.undo_edit())
+        self.root.bind("<Control-y>", lambda event: self.redo_edit())
+        
         # 主要内容框架
         main_frame = ttk.Frame(self.root)
         main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -264,6 +2243,15 @@ class ImageProcessorApp:
         self.image_list_widget = ScrollableImageList(left_frame, self)
         self.image_list_widget.pack(fill=tk.Y, expand=True)
         
+        # 缩略图生成进度（导入时显示，可以取消）
+        self.import_progress_frame = ttk.Frame(left_frame)
+        self.import_progress_label = ttk.Label(self.import_progress_frame, text="", font=("Arial", 8))
+        self.import_progress_label.pack(anchor=tk.W)
+        self.import_progress_bar = ttk.Progressbar(self.import_progress_frame, mode='determinate')
+        self.import_progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        ttk.Button(self.import_progress_frame, text="取消", width=4,
+                   command=self.cancel_import).pack(side=tk.RIGHT, padx=(5, 0))
+        
         # 右侧框架（预览和控制）
         right_frame = ttk.Frame(main_frame)
         right_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
@@ -280,6 +2268,15 @@ class ImageProcessorApp:
         self.canvas.bind("<Button-1>", self.start_watermark_drag)
         self.canvas.bind("<B1-Motion>", self.on_watermark_drag)
         self.canvas.bind("<ButtonRelease-1>", self.end_watermark_drag)
+        self.canvas.bind("<Configure>", self.on_canvas_resize)
+        
+        # 绑定鼠标滚轮缩放和中键平移
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-4>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-5>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-2>", self.start_pan)
+        self.canvas.bind("<B2-Motion>", self.on_pan)
+        self.canvas.bind("<ButtonRelease-2>", self.end_pan)
         
         # 图像信息标签
         self.info_label = ttk.Label(right_frame, text="")
@@ -297,6 +2294,7 @@ class ImageProcessorApp:
         self.brightness_scale = ttk.Scale(brightness_frame, from_=0.0, to=2.0, value=1.0, 
                                          command=self.adjust_brightness)
         self.brightness_scale.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.brightness_scale.bind('<ButtonRelease-1>', self.end_edit_action)
         
         # 对比度控制
         contrast_frame = ttk.Frame(control_frame)
@@ -306,6 +2304,7 @@ class ImageProcessorApp:
         self.contrast_scale = ttk.Scale(contrast_frame, from_=0.0, to=2.0, value=1.0, 
                                        command=self.adjust_contrast)
         self.contrast_scale.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.contrast_scale.bind('<ButtonRelease-1>', self.end_edit_action)
         
         # 滤镜按钮
         filter_frame = ttk.Frame(control_frame)
@@ -320,9 +2319,26 @@ class ImageProcessorApp:
         ttk.Button(filter_frame, text="灰度", 
                   command=self.convert_to_grayscale).pack(side=tk.LEFT, padx=(0, 5))
         
+        # 可调半径的滤镜（半径按原图像素计）
+        radius_filter_frame = ttk.Frame(control_frame)
+        radius_filter_frame.pack(fill=tk.X, pady=(0, 5))
+        
+        ttk.Label(radius_filter_frame, text="半径:").pack(side=tk.LEFT)
+        self.filter_radius = tk.DoubleVar(value=2.0)
+        radius_label = tk.StringVar(value="2.0")
+        ttk.Scale(radius_filter_frame, from_=0.5, to=50.0, variable=self.filter_radius,
+                  command=lambda value: radius_label.set(f"{float(value):.1f}")).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        ttk.Label(radius_filter_frame, textvariable=radius_label, width=5).pack(side=tk.LEFT)
+        ttk.Button(radius_filter_frame, text="高斯模糊",
+                  command=lambda: self.apply_radius_filter('gaussian_blur')).pack(side=tk.LEFT, padx=(5, 5))
+        ttk.Button(radius_filter_frame, text="USM锐化",
+                  command=lambda: self.apply_radius_filter('unsharp_mask')).pack(side=tk.LEFT, padx=(0, 5))
+        
         # 添加撤回和恢复默认按钮
         ttk.Button(filter_frame, text="撤回", 
-                  command=self.undo_filter).pack(side=tk.LEFT, padx=(10, 5))
+                  command=self.undo_edit).pack(side=tk.LEFT, padx=(10, 5))
+        ttk.Button(filter_frame, text="重做", 
+                  command=self.redo_edit).pack(side=tk.LEFT, padx=(0, 5))
         ttk.Button(filter_frame, text="恢复默认", 
                   command=self.reset_image).pack(side=tk.LEFT, padx=(0, 5))
         
@@ -331,6 +2347,7 @@ class ImageProcessorApp:
         button_frame.pack(fill=tk.X)
         
         ttk.Button(button_frame, text="水印设置", command=self.show_watermark_settings).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(button_frame, text="色调调整", command=self.show_tone_settings).pack(side=tk.LEFT, padx=(0, 5))
         ttk.Button(button_frame, text="导出图像", command=self.export_image).pack(side=tk.RIGHT)
         
         # 支持拖拽导入
@@ -379,128 +2396,607 @@ class ImageProcessorApp:
         folder_path = filedialog.askdirectory(title="选择包含图像的文件夹")
         
         if folder_path:
-            image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff')
-            image_files = []
-            
-            for file_name in os.listdir(folder_path):
-                if file_name.lower().endswith(image_extensions):
-                    image_files.append(os.path.join(folder_path, file_name))
-            
-            if image_files:
-                self.add_images_to_list(image_files)
+            self.import_paths([folder_path], "所选文件夹中没有找到支持的图像文件")
+    
+    def show_import_settings(self):
+        """显示文件夹导入设置对话框（递归深度、包含/排除的通配符、符号链接和文件头识别）"""
+        scanner = self.folder_scanner
+        
+        settings_dialog = tk.Toplevel(self.root)
+        settings_dialog.title("导入设置")
+        settings_dialog.geometry("460x280")
+        settings_dialog.transient(self.root)
+        settings_dialog.grab_set()
+        
+        main_frame = ttk.Frame(settings_dialog, padding=10)
+        main_frame.pack(fill=tk.BOTH, expand=True)
+        
+        # 最大递归深度，留空表示不限制
+        depth_frame = ttk.Frame(main_frame)
+        depth_frame.pack(fill=tk.X, pady=(0, 5))
+        ttk.Label(depth_frame, text="最大深度:", width=10).pack(side=tk.LEFT)
+        depth_var = tk.StringVar(value='' if scanner.max_depth is None else str(scanner.max_depth))
+        ttk.Entry(depth_frame, textvariable=depth_var, width=6).pack(side=tk.LEFT, padx=5)
+        ttk.Label(depth_frame, text="留空不限制，0只扫描所选文件夹").pack(side=tk.LEFT)
+        
+        # 通配符用分号分隔
+        pattern_vars = {}
+        for name, label, hint in (('include', "包含文件:", "如 *.jpg; *.png，留空不限制"),
+                                  ('exclude', "排除:", "文件名、文件夹名或相对路径，如 .*; raw")):
+            frame = ttk.Frame(main_frame)
+            frame.pack(fill=tk.X, pady=(0, 5))
+            ttk.Label(frame, text=label, width=10).pack(side=tk.LEFT)
+            pattern_vars[name] = tk.StringVar(value='; '.join(getattr(scanner, name)))
+            ttk.Entry(frame, textvariable=pattern_vars[name]).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+            ttk.Label(main_frame, text=hint, foreground="gray").pack(anchor=tk.W, padx=(80, 0))
+        
+        follow_symlinks_var = tk.BooleanVar(value=scanner.follow_symlinks)
+        ttk.Checkbutton(main_frame, text="进入符号链接指向的文件夹",
+                        variable=follow_symlinks_var).pack(anchor=tk.W)
+        sniff_var = tk.BooleanVar(value=scanner.sniff)
+        ttk.Checkbutton(main_frame, text="读取文件头识别扩展名缺失或错误的图像",
+                        variable=sniff_var).pack(anchor=tk.W)
+        
+        def apply_settings():
+            depth = depth_var.get().strip()
+            try:
+                max_depth = int(depth) if depth else None
+            except ValueError:
+                max_depth = -1
+            if max_depth is not None and max_depth < 0:
+                messagebox.showwarning("警告", "最大深度必须是非负整数")
+                return
+            patterns = {name: tuple(pattern.strip() for pattern in var.get().split(';') if pattern.strip())
+                        for name, var in pattern_vars.items()}
+            # 换成新的扫描器，正在进行的扫描不受影响
+            self.folder_scanner = FolderScanner(max_depth, patterns['include'], patterns['exclude'],
+                                                follow_symlinks_var.get(), sniff_var.get(),
+                                                scanner.batch_size, scanner.batch_interval)
+            settings_dialog.destroy()
+        
+        button_frame = ttk.Frame(main_frame)
+        button_frame.pack(fill=tk.X, pady=(10, 0))
+        ttk.Button(button_frame, text="取消", command=settings_dialog.destroy).pack(side=tk.RIGHT)
+        ttk.Button(button_frame, text="确定", command=apply_settings).pack(side=tk.RIGHT, padx=5)
+    
+    def import_paths(self, paths, empty_message):
+        """在后台线程中递归扫描文件和文件夹，找到的图像分批加入列表；一张都没有找到时显示empty_message"""
+        cancel = threading.Event()
+        results = queue.Queue()
+        
+        def scan():
+            try:
+                for batch in self.folder_scanner.scan(paths, cancel):
+                    results.put(batch)
+            except Exception as e:
+                print(f"扫描文件夹时出错: {e}")
+            finally:
+                results.put(None)
+                
+        def poll():
+            finished = False
+            while True:
+                try:
+                    batch = results.get_nowait()
+                except queue.Empty:
+                    break
+                if batch is None:
+                    finished = True
+                    break
+                if not cancel.is_set():
+                    scan_state['found'] += len(batch)
+                    self.add_images_to_list(batch)
+            if finished:
+                self.scans.remove(scan_state)
+                self.update_import_progress()
+                if scan_state['found'] == 0 and not cancel.is_set():
+                    messagebox.showinfo("提示", empty_message)
             else:
-                messagebox.showinfo("提示", "所选文件夹中没有找到支持的图像文件")
+                self.update_import_progress()
+                self.root.after(50, poll)
+                
+        scan_state = {'cancel': cancel, 'found': 0}
+        self.scans.append(scan_state)
+        threading.Thread(target=scan, name="folder-scan", daemon=True).start()
+        self.update_import_progress()
+        self.root.after(50, poll)
     
     def add_images_to_list(self, file_paths):
-        """将图像添加到列表中"""
+        """将图像添加到列表中：先显示占位图，缩略图在后台生成"""
+        added = []
         for file_path in file_paths:
-            if file_path not in [img['path'] for img in self.image_list]:
-                try:
-                    # 获取文件名（不含路径）
-                    filename = os.path.basename(file_path)
-                    # 创建缩略图
-                    thumbnail_photo = self.create_thumbnail(file_path)
-                    # 为每个图像创建独立的水印设置
-                    watermark_vars = {}
-                    for key, var in self.default_watermark_vars.items():
-                        if isinstance(var, tk.StringVar):
-                            watermark_vars[key] = tk.StringVar(value=var.get())
-                        elif isinstance(var, tk.BooleanVar):
-                            watermark_vars[key] = tk.BooleanVar(value=var.get())
-                        elif isinstance(var, tk.IntVar):
-                            watermark_vars[key] = tk.IntVar(value=var.get())
-                        elif isinstance(var, tk.DoubleVar):
-                            watermark_vars[key] = tk.DoubleVar(value=var.get())
-                            
-                    self.image_list.append({
-                        'path': file_path,
-                        'name': filename,
-                        'thumbnail': thumbnail_photo,
-                        'watermark_vars': watermark_vars
-                    })
-                    # 在图像列表中显示缩略图
-                    self.image_list_widget.add_thumbnail(file_path, thumbnail_photo, filename)
-                except Exception as e:
-                    messagebox.showerror("错误", f"无法加载图像 {file_path}:\n{str(e)}")
+            # 新图像共用默认水印设置，修改时才复制
+            if self.image_library.add(file_path, self.default_watermark) is not None:
+                self.thumbnail_status[file_path] = "加载中"
+                added.append((file_path, file_path))
+        # 列表中先显示占位图
+        self.image_list_widget.add_items([os.path.basename(path) for path, _ in added])
+        self.thumbnail_loader.submit(added)
+        self.prioritize_thumbnails()
         
         # 如果这是第一个导入的图像，自动加载它
-        if len(self.image_list) > 0 and self.current_image_index == -1:
+        if len(self.image_library) > 0 and self.current_image_index == -1:
             self.load_image(0)
     
-    def create_thumbnail(self, image_path):
-        """创建缩略图"""
-        try:
-            image = Image.open(image_path)
+    def make_thumbnail(self, image_path):
+        """生成缩略图图像，优先从持久化缓存读取（在缩略图线程中调用，不创建Tk对象）"""
+        key = ThumbnailStore.key(image_path, self.thumbnail_size)
+        image = self.thumbnail_store.get(key)
+        if image is None:
+            image = self.image_decoder.open_thumbnail(image_path, self.thumbnail_size)
+            image = ToneEngine.to_display_mode(image)
             image.thumbnail(self.thumbnail_size, Image.LANCZOS)
-            photo = ImageTk.PhotoImage(image)
-            return photo
-        except Exception as e:
-            # 如果无法创建缩略图，创建一个占位符
-            placeholder = Image.new('RGB', self.thumbnail_size, color='lightgray')
-            draw = ImageDraw.Draw(placeholder)
-            draw.text((10, self.thumbnail_size[1]//2), "无法加载", fill='black')
-            photo = ImageTk.PhotoImage(placeholder)
-            return photo
+            self.thumbnail_store.put(key, image)
+        return image
+    
+    def get_list_thumbnail(self, index):
+        """列表第index项的显示内容，返回 (缩略图, None) 或 (None, 状态文字)"""
+        path = self.image_library[index].path
+        image = self.thumbnail_images.get(path)
+        if image is not None:
+            return image, None
+        # 已生成过但被淘汰的缩略图由 prioritize_thumbnails 重新提交
+        return None, self.thumbnail_status.get(path, "加载中")
+    
+    def on_thumbnails_loaded(self, batch):
+        """显示一批生成好的缩略图，生成失败的显示为占位图"""
+        indices = []
+        for path, image, error in batch:
+            index = self.image_library.index_of(path)
+            if index is None:
+                continue
+            if error is not None:
+                print(f"无法生成缩略图 {path}: {error}")
+                self.thumbnail_status[path] = "无法加载"
+            else:
+                self.thumbnail_images.put(path, image)
+                self.thumbnail_status.pop(path, None)
+            indices.append(index)
+        self.image_list_widget.refresh_items(indices)
+    
+    def on_thumbnail_progress(self, done, total):
+        """记录缩略图生成进度"""
+        self.thumbnail_progress = (done, total)
+        self.update_import_progress()
+    
+    def update_import_progress(self):
+        """显示文件夹扫描和缩略图生成进度，全部完成后隐藏进度条"""
+        done, total = self.thumbnail_progress
+        if done < total or self.scans:
+            text = f"正在生成缩略图 {done}/{total}"
+            if self.scans:
+                text += f"（正在扫描，已找到 {sum(scan['found'] for scan in self.scans)} 张）"
+            self.import_progress_bar.configure(maximum=max(total, 1), value=done)
+            self.import_progress_label.configure(text=text)
+            if not self.import_progress_frame.winfo_ismapped():
+                self.import_progress_frame.pack(fill=tk.X, pady=(5, 0))
+        else:
+            self.import_progress_frame.pack_forget()
+    
+    def prioritize_thumbnails(self):
+        """让列表中当前可见的缩略图优先生成，已生成过但被淘汰的重新提交（通常直接命中磁盘缓存）"""
+        if hasattr(self, 'thumbnail_loader'):
+            paths = [self.image_library[index].path
+                     for index in self.image_list_widget.visible_indices(margin_rows=1)]
+            # 状态为空表示不在生成中，避免重复提交
+            evicted = [(path, path) for path in paths
+                       if path not in self.thumbnail_status and path not in self.thumbnail_images]
+            for path, _ in evicted:
+                self.thumbnail_status[path] = "加载中"
+            if evicted:
+                self.thumbnail_loader.submit(evicted)
+            self.thumbnail_loader.prioritize(paths)
+    
+    def cancel_import(self):
+        """停止正在进行的文件夹扫描，取消尚未完成的缩略图，对应的列表项显示为占位图"""
+        for scan in self.scans:
+            scan['cancel'].set()
+        self.thumbnail_loader.cancel()
+        indices = []
+        for path, status in self.thumbnail_status.items():
+            if status == "加载中":
+                self.thumbnail_status[path] = "已取消"
+                indices.append(self.image_library.index_of(path))
+        self.image_list_widget.refresh_items(indices)
     
     def load_image(self, index):
         """加载并显示图像"""
-        if 0 <= index < len(self.image_list):
+        if 0 <= index < len(self.image_library):
             self.current_image_index = index
-            image_info = self.image_list[index]
-            self.file_path = image_info['path']
+            record = self.image_library[index]
+            self.file_path = record.path
+            self.bind_watermark_vars(record)
             
             try:
                 self.original_image = Image.open(self.file_path)
-                self.processed_image = self.original_image.copy()
-                self.display_image_on_canvas()
+                self.view_zoom = None
+                # 每张图像保留自己的编辑，切换图像时恢复滑块位置
+                self.sync_tone_controls(record.edits['tone'] if record.edits is not None else dict(ToneEngine.PARAMS))
+                self.request_render()
             except Exception as e:
                 messagebox.showerror("错误", f"无法加载图像 {self.file_path}:\n{str(e)}")
     
+    def current_record(self):
+        """当前图像在图像库中的记录"""
+        return self.image_library[self.current_image_index]
+    
+    def bind_watermark_vars(self, record):
+        """把水印变量切换到record的设置（不写回）"""
+        self._binding_watermark = True
+        try:
+            for key, var in self.watermark_vars.items():
+                var.set(record.watermark[key])
+        finally:
+            self._binding_watermark = False
+    
+    def on_watermark_var_changed(self, key):
+        """水印变量修改时生成当前图像的新设置，其他图像共用的设置不受影响"""
+        if self._binding_watermark or self.current_image_index < 0:
+            return
+        try:
+            value = self.watermark_vars[key].get()
+        except (tk.TclError, ValueError):
+            # 输入框中暂时无效的值（例如正在输入的数字）
+            return
+        record = self.current_record()
+        record.watermark = record.watermark.replace(**{key: value})
+    
+    def current_edits(self):
+        """当前图像的编辑状态（第一次编辑时创建）"""
+        record = self.current_record()
+        if record.edits is None:
+            # 非破坏性编辑：色调参数和依次应用的滤镜/灰度操作
+            record.edits = {'tone': dict(ToneEngine.PARAMS), 'ops': [], 'history': EditHistory()}
+        return record.edits
+    
+    def get_edit_ops(self):
+        """当前图像的编辑操作序列：色调阶段在前，之后是依次应用的滤镜和灰度"""
+        if self.current_image_index < 0 or self.current_record().edits is None:
+            return ()
+        edits = self.current_edits()
+        tone = edits['tone']
+        ops = tuple(edits['ops'])
+        if not ToneEngine.is_identity(tone):
+            ops = (('tone', tuple((name, tone[name]) for name, _ in ToneEngine.PARAMS)),) + ops
+        return ops
+    
+    @property
+    def processed_image(self):
+        """全分辨率的编辑结果，只在导出等确实需要时由编辑流水线计算"""
+        if self.original_image is None:
+            return None
+        with self.image_lock:
+            return self.export_pipeline.run(self.original_image, self.get_edit_ops())
+    
+    def apply_edit_op(self, image, op, scale=1.0, contrast_mean=None):
+        """对图像应用一个编辑操作，返回新图像
+        
+        scale 为图像相对原图的缩放比例（滤镜半径按此换算）；给出 contrast_mean 时对比度调整以该灰度均值为中心，
+        而不是按本图统计（用于分块处理）
+        """
+        if op[0] == 'tone':
+            # 所有色调参数合成一张查找表，一次处理完成
+            return self.tone_engine.apply(image, dict(op[1]), pivot=contrast_mean)
+        elif op[0] == 'grayscale':
+            return image.convert("L")
+        image_filter = FilterExecutor.op_filter(op, scale)
+        if image_filter is not None:
+            return self.filter_executor.apply(image, image_filter)
+        return image
+    
+    def apply_edit_ops(self, image, ops, contrast_means=None, scale=1.0):
+        """按顺序对图像应用编辑操作，返回新图像
+        
+        contrast_means 为 {操作序号: 均值}，给出时对比度调整使用这些均值而不是按本图统计（用于分块处理）
+        """
+        result = image.copy()
+        for index, op in enumerate(ops):
+            result = self.apply_edit_op(result, op, scale, None if contrast_means is None else contrast_means.get(index))
+        return result
+    
+    def measure_contrast_means(self, image, ops, scale=1.0):
+        """依次应用编辑操作，记录每个对比度调整时图像的灰度均值"""
+        means = {}
+        for index, op in enumerate(ops):
+            if op[0] == 'tone':
+                means[index] = self.tone_engine.contrast_pivot(image, dict(op[1]))
+            image = self.apply_edit_op(image, op, scale, means.get(index))
+        return means
+    
+    def get_canvas_size(self):
+        """获取画布尺寸"""
+        canvas_width = self.canvas.winfo_width()
+        canvas_height = self.canvas.winfo_height()
+        
+        # 如果画布尺寸为1（初始状态），使用预览框架的尺寸
+        if canvas_width <= 1 or canvas_height <= 1:
+            canvas_width = self.canvas.winfo_reqwidth()
+            canvas_height = self.canvas.winfo_reqheight()
+        return canvas_width, canvas_height
+    
+    def update_preview_source(self, image, path, canvas_size):
+        """按画布尺寸生成原图的预览代理图像，原图和尺寸不变时直接复用（在渲染线程中调用）"""
+        canvas_width, canvas_height = canvas_size
+        
+        # 计算缩放比例
+        img_width, img_height = image.size
+        scale = min(canvas_width / img_width, canvas_height / img_height, 1.0)  # 不放大图像
+        size = (max(1, int(img_width * scale)), max(1, int(img_height * scale)))
+        
+        cached = self.preview_source
+        if cached is None or cached[0] is not image or cached[1] != size:
+            source = None
+            if size != image.size and image.format in ImageDecoder.REDUCIBLE_FORMATS:
+                # 只解码不小于预览尺寸的缩小版本，不必完整解码原图
+                try:
+                    source, _ = self.image_decoder.open(path, size)
+                    source = ToneEngine.to_display_mode(source)
+                except Exception as e:
+                    print(f"缩小解码 {path} 时出错: {e}")
+            if source is not None:
+                proxy = source.resize(size, Image.LANCZOS, reducing_gap=2.0) if size != source.size else source
+            else:
+                with self.image_lock:
+                    source = ToneEngine.to_display_mode(image)
+                    if size != source.size:
+                        proxy = source.resize(size, Image.LANCZOS, reducing_gap=2.0)
+                    else:
+                        proxy = source.copy()
+            # 预览坐标与原图坐标的比例（水印几何参数按此缩放）
+            cached = self.preview_source = (image, size, proxy, size[0] / img_width)
+        return cached[2], cached[3]
+    
+    def get_preview_image(self, source, ops, scale):
+        """获取应用了编辑操作的预览代理图像，未改变的阶段直接复用（在渲染线程中调用）"""
+        return self.preview_pipeline.run(source, ops, scale)
+    
+    def get_view_origin(self, image_size, canvas_size, scale, center):
+        """计算放大查看时原图左上角在画布中的位置，返回 (限制后的中心, 位置)"""
+        center = list(center)
+        origin = []
+        for axis in (0, 1):
+            display = image_size[axis] * scale
+            half = canvas_size[axis] / 2
+            if display <= canvas_size[axis]:
+                # 图像小于画布时居中显示
+                center[axis] = image_size[axis] / 2
+            else:
+                # 不允许平移到图像范围之外
+                center[axis] = max(half / scale, min(center[axis], image_size[axis] - half / scale))
+            origin.append(round(half - center[axis] * scale))
+        return tuple(center), tuple(origin)
+    
+    def get_preview_pyramid(self, image, path):
+        """获取原图的图块金字塔，原图改变时重新建立（在渲染线程中调用）"""
+        if self.preview_pyramid is None or self.preview_pyramid.image is not image:
+            self.preview_pyramid = TilePyramid(image, self.apply_edit_ops, self.measure_contrast_means,
+                                               decode=lambda level: self.decode_preview_level(image, path, level))
+        return self.preview_pyramid
+    
+    def decode_preview_level(self, image, path, level):
+        """以金字塔第level级的分辨率解码原图，格式不支持缩小解码时返回None（在渲染线程中调用）"""
+        if level == 0:
+            with self.image_lock:
+                image.load()
+                return ToneEngine.to_display_mode(image)
+        if image.format not in ImageDecoder.REDUCIBLE_FORMATS:
+            return None
+        # 请求向下取整的尺寸，解码结果恰好是缩小2^level倍后向上取整的尺寸
+        size = (max(1, image.width >> level), max(1, image.height >> level))
+        try:
+            decoded, _ = self.image_decoder.open(path, size)
+            return ToneEngine.to_display_mode(decoded)
+        except Exception as e:
+            print(f"缩小解码 {path} 时出错: {e}")
+            return None
+    
+    def render_preview(self, snapshot):
+        """根据状态快照渲染预览图像（在渲染线程中执行，不访问Tk对象）"""
+        start_time = time.perf_counter()
+        canvas_width, canvas_height = snapshot['canvas_size']
+        if snapshot['view'] is None:
+            # 适应画布：在画布分辨率的代理图像上渲染
+            source, scale = self.update_preview_source(snapshot['image'], snapshot['path'], snapshot['canvas_size'])
+            preview_image = self.get_preview_image(source, snapshot['ops'], scale)
+            size = preview_image.size
+            origin = ((canvas_width - size[0]) // 2, (canvas_height - size[1]) // 2)
+            box = (0, 0) + size
+        else:
+            # 放大查看：只渲染画布中可见的图块
+            scale, center = snapshot['view']
+            image_width, image_height = snapshot['image'].size
+            size = (max(1, round(image_width * scale)), max(1, round(image_height * scale)))
+            _, origin = self.get_view_origin(snapshot['image'].size, snapshot['canvas_size'], scale, center)
+            box = (max(0, -origin[0]), max(0, -origin[1]),
+                   min(size[0], canvas_width - origin[0]), min(size[1], canvas_height - origin[1]))
+            preview_image = self.get_preview_pyramid(snapshot['image'], snapshot['path']).render(scale, box, snapshot['ops'])
+        result = {'snapshot': snapshot, 'image': preview_image, 'scale': scale, 'size': size,
+                  'origin': origin, 'position': (origin[0] + box[0], origin[1] + box[1]),
+                  'drag_sprite': None, 'shapes': []}
+        if snapshot['settings'] is None:
+            result['render_time'] = time.perf_counter() - start_time
+            return result
+        
+        # 应用水印（水印几何参数按预览比例缩放，坐标相对缩放后的整图）
+        placements = self.get_watermark_placements(size, scale, snapshot['settings'])
+        result['shapes'] = [(kind, outline, x, y) for kind, _, x, y, outline in placements]
+        # 拖拽时被拖动的水印不合成到底图中，单独返回以便在画布上移动
+        if snapshot['exclude'] is not None:
+            for placement in placements:
+                if placement[0] == snapshot['exclude']:
+                    result['drag_sprite'] = placement[1]
+                    result['drag_box'] = WatermarkGeometry.bounds(placement[4])
+            placements = [placement for placement in placements if placement[0] != snapshot['exclude']]
+        if box[:2] != (0, 0):
+            placements = [(kind, sprite, x - box[0], y - box[1], outline)
+                          for kind, sprite, x, y, outline in placements]
+        # 放大查看时的图块拼接结果是新建的图像，直接在上面合成；适应画布的代理图像来自缓存，需要复制
+        result['image'] = self.composite_sprites(preview_image, placements, in_place=snapshot['view'] is not None)
+        result['render_time'] = time.perf_counter() - start_time
+        return result
+    
     def display_image_on_canvas(self):
-        """在画布上显示图像"""
-        if self.processed_image:
-            # 应用水印
-            watermarked_image = self.apply_watermark(self.processed_image)
-            
-            # 获取画布尺寸
-            canvas_width = self.canvas.winfo_width()
-            canvas_height = self.canvas.winfo_height()
-            
-            # 如果画布尺寸为1（初始状态），使用预览框架的尺寸
-            if canvas_width <= 1 or canvas_height <= 1:
-                canvas_width = self.canvas.winfo_reqwidth()
-                canvas_height = self.canvas.winfo_reqheight()
-            
-            # 计算缩放比例
-            img_width, img_height = watermarked_image.size
-            scale_x = canvas_width / img_width
-            scale_y = canvas_height / img_height
-            scale = min(scale_x, scale_y, 1.0)  # 不放大图像
-            
-            # 计算新尺寸
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
-            
-            # 调整图像大小
-            resized_image = watermarked_image.resize((new_width, new_height), Image.LANCZOS)
-            
-            # 创建PhotoImage
-            self.display_image = ImageTk.PhotoImage(resized_image)
-            
-            # 清空画布
-            self.canvas.delete("all")
-            
-            # 在画布中心显示图像
-            x = (canvas_width - new_width) // 2
-            y = (canvas_height - new_height) // 2
-            self.canvas.create_image(x, y, anchor=tk.NW, image=self.display_image)
-            
-            # 更新图像信息
-            width, height = self.original_image.size
-            file_size = os.path.getsize(self.file_path)
-            file_size_str = self.format_file_size(file_size)
-            image_info = f"尺寸: {width}x{height}px\n文件大小: {file_size_str}\n图像 {self.current_image_index + 1}/{len(self.image_list)}"
-            self.info_label.config(text=image_info)
+        """提交预览渲染任务（在画布分辨率的代理图像上渲染，与原图像素数无关）"""
+        if self.original_image:
+            # 在主线程中生成不可变的状态快照，渲染在后台线程进行
+            # 水印设置不可变，直接放入快照
+            settings = self.current_record().watermark
+            snapshot = {
+                'image': self.original_image,
+                'path': self.file_path,
+                'index': self.current_image_index,
+                'canvas_size': self.get_canvas_size(),
+                'ops': self.get_edit_ops(),
+                'settings': settings,
+                'view': None if self.view_zoom is None else (self.view_zoom, self.view_center),
+                # 拖拽水印时，被拖动的水印单独渲染
+                'exclude': self.watermark_drag_data.get("type") if self.watermark_drag_data["dragging"] else None,
+            }
+            self.render_worker.submit(self.render_preview, snapshot)
+    
+    def show_rendered_preview(self, result, error):
+        """在画布上显示后台渲染完成的预览（在主线程中执行）"""
+        if error is not None:
+            messagebox.showerror("错误", f"无法显示图像 {self.file_path}:\n{str(error)}")
+            return
+        if result['snapshot']['image'] is not self.original_image:
+            return
+        watermarked_image = result['image']
+        drag_sprite = result['drag_sprite']
+        
+        # 复用相同模式和尺寸的PhotoImage，原地更新像素，避免每帧创建新的Tcl图像
+        transfer_start = time.perf_counter()
+        mode = 'RGBA' if watermarked_image.mode == 'RGBA' else 'RGB'
+        key = (mode, watermarked_image.size)
+        photo = self.preview_photos.get(key)
+        if photo is None:
+            photo = self.preview_photos.put(key, ImageTk.PhotoImage(mode, watermarked_image.size))
+        photo.paste(watermarked_image)
+        
+        # 显示图像（适应画布时居中，放大时为可见区域），画布图像项只创建一次
+        x, y = result['position']
+        if self.preview_item is None:
+            self.preview_item = self.canvas.create_image(x, y, anchor=tk.NW, image=photo)
+        else:
+            if photo is not self.display_image:
+                self.canvas.itemconfig(self.preview_item, image=photo)
+            if tuple(self.canvas.coords(self.preview_item)) != (x, y):
+                self.canvas.coords(self.preview_item, x, y)
+        self.display_image = photo
+        self.preview_size = result['size']
+        self.preview_timing['frames'] += 1
+        self.preview_timing['render_ms'] = result['render_time'] * 1000
+        self.preview_timing['transfer_ms'] = (time.perf_counter() - transfer_start) * 1000
+        
+        # 发布水印几何信息，点击检测直接使用，无需重新计算
+        self.watermark_geometry.publish(result['shapes'], result['scale'], result['origin'])
+        
+        # 拖拽中：被拖动的水印作为单独的画布图像，随鼠标移动
+        if self.watermark_drag_data["sprite_item"] is not None:
+            self.canvas.delete(self.watermark_drag_data["sprite_item"])
+        self.drag_sprite_photo = None
+        self.watermark_drag_data["sprite_item"] = None
+        if drag_sprite is not None and self.watermark_drag_data["dragging"]:
+            self.drag_sprite_photo = ImageTk.PhotoImage(drag_sprite)
+            self.watermark_drag_data["sprite_box"] = result['drag_box']
+            self.watermark_drag_data["sprite_item"] = self.canvas.create_image(
+                x, y, anchor=tk.NW, image=self.drag_sprite_photo)
+            self.move_drag_sprite()
+        
+        # 更新图像信息（包括编辑历史和编辑缓存的内存占用）
+        # 只读取编辑状态，还没有编辑过的图像不创建
+        edits = self.current_record().edits
+        history = edits['history'] if edits is not None else None
+        memory = self.export_pipeline.memory() + self.preview_pipeline.memory()
+        undo_steps = redo_steps = 0
+        if history is not None:
+            memory += history.memory()
+            undo_steps, redo_steps = len(history.undo_stack), len(history.redo_stack)
+        width, height = self.original_image.size
+        file_size = os.path.getsize(self.file_path)
+        file_size_str = self.format_file_size(file_size)
+        image_info = (f"尺寸: {width}x{height}px\n文件大小: {file_size_str}\n图像 {self.current_image_index + 1}/{len(self.image_library)}"
+                      f"  缩放: {result['scale'] * 100:.0f}%"
+                      f"  处理: {self.preview_timing['render_ms']:.1f}ms  显示: {self.preview_timing['transfer_ms']:.1f}ms"
+                      f"\n历史: {undo_steps}步可撤回/{redo_steps}步可重做"
+                      f"  编辑缓存: {self.format_file_size(memory)}"
+                      f"\n{self.format_cache_stats()}")
+        self.info_label.config(text=image_info)
+    
+    def format_cache_stats(self):
+        """各缓存的 命中次数/查询次数 和渲染合并情况，显示在图像信息中"""
+        def ratio(stats):
+            return f"{stats['hits']}/{stats['hits'] + stats['misses']}"
+        parts = [f"字体 {ratio(self.font_resolver.stats()['fonts'])}",
+                 f"预览 {ratio(self.preview_pipeline.stats())}",
+                 f"导出 {ratio(self.export_pipeline.stats())}"]
+        pyramid = self.preview_pyramid
+        if pyramid is not None:
+            parts.append(f"图块 {ratio(pyramid.stats())}")
+        parts.append(f"缩略图 {ratio(self.thumbnail_store.stats())}")
+        scheduler = self.render_scheduler.stats()
+        parts.append(f"渲染 {scheduler['executed']}/{scheduler['requested']}次")
+        return "缓存命中: " + "  ".join(parts)
+    
+    def on_canvas_resize(self, event):
+        """画布尺寸改变时按新尺寸重新生成预览"""
+        if self.original_image:
+            self.request_render()
+    
+    def zoom_view(self, factor, absolute=None, anchor=None):
+        """缩放预览，anchor为保持不动的画布坐标（默认画布中心）"""
+        if not self.original_image:
+            return
+        canvas_width, canvas_height = self.get_canvas_size()
+        image_width, image_height = self.original_image.size
+        fit_scale = min(canvas_width / image_width, canvas_height / image_height, 1.0)
+        current = self.watermark_geometry.scale if self.view_zoom is None else self.view_zoom
+        zoom = min(absolute if absolute is not None else current * factor, self.MAX_ZOOM)
+        if zoom <= fit_scale:
+            self.fit_view()
+            return
+        
+        # 保持anchor处的图像点在缩放后仍位于同一画布位置
+        if anchor is None:
+            anchor = (canvas_width / 2, canvas_height / 2)
+        image_x, image_y = self.watermark_geometry.canvas_to_image(*anchor)
+        center = (image_x - (anchor[0] - canvas_width / 2) / zoom,
+                  image_y - (anchor[1] - canvas_height / 2) / zoom)
+        self.view_zoom = zoom
+        self.view_center, _ = self.get_view_origin(self.original_image.size, (canvas_width, canvas_height), zoom, center)
+        self.request_render()
+    
+    def fit_view(self):
+        """预览恢复为适应画布"""
+        self.view_zoom = None
+        self.request_render()
+    
+    def on_mouse_wheel(self, event):
+        """鼠标滚轮以光标位置为中心缩放预览"""
+        if event.num == 4 or event.delta > 0:
+            self.zoom_view(self.ZOOM_STEP, anchor=(event.x, event.y))
+        elif event.num == 5 or event.delta < 0:
+            self.zoom_view(1 / self.ZOOM_STEP, anchor=(event.x, event.y))
+    
+    def start_pan(self, event):
+        """开始平移放大的预览"""
+        if self.view_zoom is not None:
+            self.pan_data = (event.x, event.y, self.view_center)
+    
+    def on_pan(self, event):
+        """平移放大的预览"""
+        if self.pan_data is None or self.view_zoom is None:
+            return
+        start_x, start_y, (center_x, center_y) = self.pan_data
+        center = (center_x - (event.x - start_x) / self.view_zoom,
+                  center_y - (event.y - start_y) / self.view_zoom)
+        self.view_center, _ = self.get_view_origin(self.original_image.size, self.get_canvas_size(),
+                                                   self.view_zoom, center)
+        self.request_render()
+    
+    def end_pan(self, event):
+        """结束平移"""
+        self.pan_data = None
     
     def format_file_size(self, size):
         for unit in ['B', 'KB', 'MB', 'GB']:
@@ -509,340 +3005,401 @@ class ImageProcessorApp:
             size /= 1024.0
         return f"{size:.1f} TB"
     
+    def edit_state(self):
+        """当前图像编辑状态的不可变记录"""
+        edits = self.current_edits()
+        return tuple(edits['tone'][name] for name, _ in ToneEngine.PARAMS), tuple(edits['ops'])
+    
+    def record_edit(self, action=None):
+        """修改编辑前记录历史"""
+        if not self._restoring_edits:
+            self.current_edits()['history'].record(self.edit_state(), action)
+    
+    def end_edit_action(self, event=None):
+        """松开滑块时结束合并，下一次拖动同一滑块记录为新的一步"""
+        if self.original_image and self.current_record().edits is not None:
+            self.current_edits()['history'].end_action()
+    
+    def restore_edit_state(self, state):
+        """恢复历史中的编辑状态，并同步滑块位置"""
+        edits = self.current_edits()
+        tone, ops = state
+        edits['tone'].update(zip((name for name, _ in ToneEngine.PARAMS), tone))
+        edits['ops'] = list(ops)
+        self.sync_tone_controls(edits['tone'])
+        self.request_render()
+    
+    def sync_tone_controls(self, tone):
+        """把亮度、对比度滑块和打开的色调对话框同步到tone的参数（不记录历史）"""
+        self._restoring_edits = True
+        try:
+            self.brightness_scale.set(tone['brightness'])
+            self.contrast_scale.set(tone['contrast'])
+            if self.tone_dialog_vars is not None:
+                for name, var in self.tone_dialog_vars.items():
+                    var.set(tone[name])
+        finally:
+            self._restoring_edits = False
+    
+    def set_tone(self, name, value):
+        """修改色调阶段的一个参数，保留其他色调参数和已应用的滤镜"""
+        # 同步滑块位置时参数已经是目标值，不需要处理
+        if self.original_image and not self._restoring_edits:
+            edits = self.current_record().edits
+            tone = edits['tone'] if edits is not None else dict(ToneEngine.PARAMS)
+            if tone[name] == float(value):
+                return
+            # 拖动同一滑块的连续修改只记录一步历史
+            self.record_edit(('tone', name))
+            self.current_edits()['tone'][name] = float(value)
+            self.request_render()
+    
     def adjust_brightness(self, value):
-        if self.original_image:
-            brightness = float(value)
-            enhancer = ImageEnhance.Brightness(self.original_image)
-            self.processed_image = enhancer.enhance(brightness)
-            self.display_image_on_canvas()
+        self.set_tone('brightness', value)
     
     def adjust_contrast(self, value):
-        if self.original_image:
-            contrast = float(value)
-            enhancer = ImageEnhance.Contrast(self.original_image)
-            self.processed_image = enhancer.enhance(contrast)
-            self.display_image_on_canvas()
+        self.set_tone('contrast', value)
+    
+    def show_tone_settings(self):
+        """显示色调调整对话框（伽马、色阶和曲线）"""
+        if not self.original_image:
+            messagebox.showwarning("警告", "请先选择一张图像")
+            return
+        if self.tone_dialog_vars is not None:
+            # 对话框已打开（它始终显示当前图像的参数）
+            self.tone_dialog.lift()
+            return
+        edits = self.current_record().edits
+        tone = edits['tone'] if edits is not None else dict(ToneEngine.PARAMS)
+        
+        tone_dialog = tk.Toplevel(self.root)
+        tone_dialog.title("色调调整")
+        tone_dialog.geometry("400x320")
+        tone_dialog.transient(self.root)
+        
+        main_frame = ttk.Frame(tone_dialog, padding=10)
+        main_frame.pack(fill=tk.BOTH, expand=True)
+        
+        # (参数, 标签, 最小值, 最大值)
+        controls = [('gamma', "伽马:", 0.2, 3.0),
+                    ('black', "色阶黑场:", 0, 254),
+                    ('white', "色阶白场:", 1, 255),
+                    ('shadows', "曲线阴影:", -64, 64),
+                    ('midtones', "曲线中间调:", -64, 64),
+                    ('highlights', "曲线高光:", -64, 64)]
+        tone_vars = {}
+        for name, label, minimum, maximum in controls:
+            frame = ttk.Frame(main_frame)
+            frame.pack(fill=tk.X, pady=(0, 5))
+            ttk.Label(frame, text=label, width=10).pack(side=tk.LEFT)
+            tone_vars[name] = tk.DoubleVar(value=tone[name])
+            scale = ttk.Scale(frame, from_=minimum, to=maximum, variable=tone_vars[name],
+                              command=lambda value, name=name: self.set_tone(name, value))
+            scale.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+            scale.bind('<ButtonRelease-1>', self.end_edit_action)
+        
+        self.tone_dialog = tone_dialog
+        self.tone_dialog_vars = tone_vars
+        
+        def on_destroy(event):
+            if event.widget is tone_dialog:
+                self.tone_dialog_vars = None
+        tone_dialog.bind('<Destroy>', on_destroy)
+        
+        def reset_tone():
+            # 切换图像后对话框作用于新的当前图像
+            if not self.original_image:
+                return
+            self.record_edit()
+            tone = self.current_edits()['tone']
+            defaults = dict(ToneEngine.PARAMS)
+            for name in tone_vars:
+                tone[name] = defaults[name]
+            self.sync_tone_controls(tone)
+            self.request_render()
+        
+        button_frame = ttk.Frame(main_frame)
+        button_frame.pack(fill=tk.X, pady=(10, 0))
+        ttk.Button(button_frame, text="关闭", command=tone_dialog.destroy).pack(side=tk.RIGHT)
+        ttk.Button(button_frame, text="重置", command=reset_tone).pack(side=tk.RIGHT, padx=5)
     
     def apply_filter(self, filter_type):
-        if self.processed_image:
+        if self.original_image:
             # 保存当前状态以支持撤回操作
-            self.redo_image = self.processed_image.copy()
-            self.processed_image = self.processed_image.filter(filter_type)
-            self.display_image_on_canvas()
+            self.record_edit()
+            edits = self.current_edits()
+            edits['ops'] = edits['ops'] + [('filter', filter_type)]
+            self.request_render()
+    
+    def apply_radius_filter(self, kind):
+        """应用可调半径的滤镜（高斯模糊或USM锐化）"""
+        if self.original_image:
+            radius = round(self.filter_radius.get(), 1)
+            op = ('gaussian_blur', radius) if kind == 'gaussian_blur' else ('unsharp_mask', radius, 150, 3)
+            # 保存当前状态以支持撤回操作
+            self.record_edit()
+            edits = self.current_edits()
+            edits['ops'] = edits['ops'] + [op]
+            self.request_render()
     
     def convert_to_grayscale(self):
-        if self.processed_image:
+        if self.original_image:
             # 保存当前状态以支持撤回操作
-            self.redo_image = self.processed_image.copy()
-            self.processed_image = self.processed_image.convert("L")
-            self.display_image_on_canvas()
-    
-    def undo_filter(self):
-        """撤回上一次滤镜操作"""
-        if self.original_image and self.redo_image:
-            # 交换当前图像和重做图像
-            temp = self.processed_image
-            self.processed_image = self.redo_image
-            self.redo_image = temp
-            self.display_image_on_canvas()
-        elif self.original_image:
-            # 如果没有重做图像，恢复到原始图像
-            self.redo_image = self.processed_image
-            self.processed_image = self.original_image.copy()
-            self.display_image_on_canvas()
+            self.record_edit()
+            edits = self.current_edits()
+            edits['ops'] = edits['ops'] + [('grayscale',)]
+            self.request_render()
+    
+    def undo_edit(self):
+        """撤回上一步编辑"""
+        if self.original_image and self.current_record().edits is not None:
+            state = self.current_edits()['history'].undo(self.edit_state())
+            if state is not None:
+                self.restore_edit_state(state)
+    
+    def redo_edit(self):
+        """重做被撤回的编辑"""
+        if self.original_image and self.current_record().edits is not None:
+            state = self.current_edits()['history'].redo(self.edit_state())
+            if state is not None:
+                self.restore_edit_state(state)
     
     def reset_image(self):
-        """恢复图像到初始状态"""
+        """恢复图像到初始状态（可以撤回）"""
         if self.original_image:
-            self.processed_image = self.original_image.copy()
-            self.redo_image = None  # 清除重做历史
-            self.brightness_scale.set(1.0)
-            self.contrast_scale.set(1.0)
-            self.display_image_on_canvas()
-    
-    def apply_watermark(self, image):
-        """应用水印到图像"""
-        if not image or self.current_image_index < 0:
-            return image
-            
-        # 获取当前图像的水印设置
-        current_image = self.image_list[self.current_image_index]
-        if 'watermark_vars' not in current_image:
-            return image
-            
-        watermark_vars = current_image['watermark_vars']
-        
-        # 创建水印图像
-        watermark = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(watermark)
-        
-        # 应用文本水印（如果设置了文本内容）
-        text = watermark_vars['text'].get()
-        if text:
-            # 获取字体设置
-            font_family = watermark_vars['font_family'].get()
-            font_size = watermark_vars['font_size'].get()
-            bold = watermark_vars['bold'].get()
-            italic = watermark_vars['italic'].get()
-            
-            # 尝试加载字体
-            font_obj = None
-            try:
-                # 在Windows上尝试加载系统字体
-                if os.name == 'nt':  # Windows
-                    # 构造字体文件名
-                    font_filename = font_family.lower().replace(' ', '')
-                    # 根据粗体和斜体设置构造字体文件名
-                    if bold and italic:
-                        font_path = f"C:/Windows/Fonts/{font_filename}bi.ttf"
-                    elif bold:
-                        font_path = f"C:/Windows/Fonts/{font_filename}bd.ttf"  # bd instead of b
-                    elif italic:
-                        font_path = f"C:/Windows/Fonts/{font_filename}i.ttf"
-                    else:
-                        font_path = f"C:/Windows/Fonts/{font_filename}.ttf"
-                        
-                    if not os.path.exists(font_path):
-                        # 尝试其他可能的命名方式
-                        if bold and italic:
-                            font_path = f"C:/Windows/Fonts/{font_filename}-bolditalic.ttf"
-                        elif bold:
-                            font_path = f"C:/Windows/Fonts/{font_filename}-bold.ttf"
-                        elif italic:
-                            font_path = f"C:/Windows/Fonts/{font_filename}-italic.ttf"
-                            
-                    if os.path.exists(font_path):
-                        font_obj = ImageFont.truetype(font_path, font_size)
-            except Exception as e:
-                print(f"加载字体时出错: {e}")
-                pass
-                
-            # 如果上面的方法失败了，尝试使用 PIL 的默认字体处理方式
-            if font_obj is None:
-                try:
-                    # 尝试使用系统字体加载
-                    font_obj = ImageFont.truetype(font_family, font_size)
-                except:
-                    try:
-                        # 如果指定字体失败，尝试使用支持中文的默认字体
-                        # 在Windows上尝试使用支持中文的字体
-                        if os.name == 'nt':
-                            chinese_fonts = [
-                                "C:/Windows/Fonts/msyh.ttc",      # 微软雅黑
-                                "C:/Windows/Fonts/simhei.ttf",    # 黑体
-                                "C:/Windows/Fonts/simsun.ttc",    # 宋体
-                                "C:/Windows/Fonts/msgothic.ttc"   # 微软正黑体
-                            ]
-                            
-                            for font_path in chinese_fonts:
-                                if os.path.exists(font_path):
-                                    try:
-                                        font_obj = ImageFont.truetype(font_path, font_size)
-                                        break
-                                    except:
-                                        continue
-                                    
-                        # 如果还是失败，使用默认字体
-                        if font_obj is None:
-                            font_obj = ImageFont.load_default()
-                    except:
-                        font_obj = ImageFont.load_default()
-                
-            # 获取文本颜色和透明度
-            color = watermark_vars['color'].get()
-            # 将0-100的透明度转换为0-255（现在是数值越高越透明）
-            opacity_percent = watermark_vars['opacity'].get()
-            opacity = int((100 - opacity_percent) * 2.55)  # 转换为0-255范围，100变为0（完全透明），0变为255（完全不透明）
-            
-            # 解析颜色
-            if color.startswith('#'):
-                r = int(color[1:3], 16)
-                g = int(color[3:5], 16)
-                b = int(color[5:7], 16)
-            else:
-                r, g, b = 0, 0, 0
-                
-            text_color = (r, g, b, opacity)
-            
-            # 获取文本尺寸
-            bbox = draw.textbbox((0, 0), text, font=font_obj)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
+            self.record_edit()
+            self.restore_edit_state((tuple(default for _, default in ToneEngine.PARAMS), ()))
+    
+    @staticmethod
+    def upscale_placement(placement, factor):
+        """把水印图像、位置和轮廓放大factor倍（与放大查看时的底图一样保持像素清晰）"""
+        kind, sprite, x, y, outline = placement
+        size = (max(1, round(sprite.width * factor)), max(1, round(sprite.height * factor)))
+        return (kind, sprite.resize(size, Image.NEAREST), round(x * factor), round(y * factor),
+                [(px * factor, py * factor) for px, py in outline])
+        
+    def scale_watermark_settings(self, settings, scale):
+        """按比例缩放水印的位置和图片缩放（文本字号在渲染文本水印时按比例换算）"""
+        settings = dict(settings)
+        settings['image_scale'] = settings['image_scale'] * scale
+        for key in ('custom_x', 'custom_y', 'image_custom_x', 'image_custom_y'):
+            settings[key] = int(settings[key] * scale)
+        return settings
+    
+    def get_text_sprite(self, settings, scale=1.0):
+        """获取按scale渲染好的文本水印图像及其文本框轮廓，相同渲染参数只渲染一次"""
+        # 字体目录就绪后字体文件可能改变，因此把就绪状态也作为键的一部分
+        key = (self.font_catalog.ready.is_set(), scale) + tuple(settings[name] for name in self.TEXT_SPRITE_KEYS)
+        entry = self.text_sprite_cache.get(key)
+        if entry is None:
+            with self._sprite_lock:
+                entry = self.text_sprite_cache.get(key)
+                if entry is None:
+                    entry = self.text_sprite_cache.put(key, self.render_text_sprite(settings, scale))
+        return entry
+    
+    def render_text_sprite(self, settings, scale=1.0):
+        """按scale渲染文本水印（含阴影、描边、粗体、斜体和旋转），返回RGBA图像和文本框（含边距）的轮廓多边形"""
+        text = settings['text']
+        # 获取字体设置（字号按渲染比例换算）
+        font_family = settings['font_family']
+        font_size = max(1, round(settings['font_size'] * scale))
+        bold = settings['bold']
+        italic = settings['italic']
+        
+        # 从字体解析器获取字体（命中缓存时不访问磁盘）
+        font_obj = self.font_resolver.get_font(font_family, font_size, bold, italic)
             
-            # 创建单独的文本图像用于旋转
-            text_image = Image.new('RGBA', (text_width + 20, text_height + 20), (0, 0, 0, 0))
-            text_draw = ImageDraw.Draw(text_image)
+        # 获取文本颜色和透明度
+        color = settings['color']
+        # 将0-100的透明度转换为0-255（现在是数值越高越透明）
+        opacity_percent = settings['opacity']
+        opacity = int((100 - opacity_percent) * 2.55)  # 转换为0-255范围，100变为0（完全透明），0变为255（完全不透明）
+        
+        # 解析颜色
+        if color.startswith('#'):
+            r = int(color[1:3], 16)
+            g = int(color[3:5], 16)
+            b = int(color[5:7], 16)
+        else:
+            r, g, b = 0, 0, 0
             
-            # 绘制阴影
-            if watermark_vars['shadow'].get():
-                shadow_color = (0, 0, 0, opacity // 2)
-                text_draw.text((10 + 2, 10 + 2), text, font=font_obj, fill=shadow_color)
-                
-            # 绘制描边
-            if watermark_vars['outline'].get():
-                outline_color = watermark_vars['outline_color'].get()
-                if outline_color.startswith('#'):
-                    or_val = int(outline_color[1:3], 16)
-                    og_val = int(outline_color[3:5], 16)
-                    ob_val = int(outline_color[5:7], 16)
-                else:
-                    or_val, og_val, ob_val = 255, 255, 255
-                    
-                outline_color_rgba = (or_val, og_val, ob_val, opacity)
-                
-                # 绘制描边（在文本周围绘制多个偏移的文本）
-                for dx in [-1, 0, 1]:
-                    for dy in [-1, 0, 1]:
-                        if dx != 0 or dy != 0:
-                            text_draw.text((10 + dx, 10 + dy), text, font=font_obj, fill=outline_color_rgba)
-            
-            # 绘制主文本
-            # 处理粗体和斜体效果
-            if bold and italic:
-                # 手动实现粗体效果（通过多次绘制偏移）
-                for dx in [-1, 0, 1]:
-                    for dy in [-1, 0, 1]:
-                        if dx != 0 or dy != 0:
-                            text_draw.text((10 + dx, 10 + dy), text, font=font_obj, fill=text_color)
-            elif bold:
-                # 手动实现粗体效果
-                for dx in [-1, 0, 1]:
-                    for dy in [-1, 0, 1]:
-                        if dx != 0 or dy != 0:
-                            text_draw.text((10 + dx, 10 + dy), text, font=font_obj, fill=text_color)
-            elif italic:
-                # 实现斜体效果 - 通过水平错切变换
-                # 先正常绘制文本
-                text_draw.text((10, 10), text, font=font_obj, fill=text_color)
+        text_color = (r, g, b, opacity)
+        
+        # 解析描边颜色
+        outline_color_rgba = None
+        if settings['outline']:
+            outline_color = settings['outline_color']
+            if outline_color.startswith('#'):
+                or_val = int(outline_color[1:3], 16)
+                og_val = int(outline_color[3:5], 16)
+                ob_val = int(outline_color[5:7], 16)
             else:
-                text_draw.text((10, 10), text, font=font_obj, fill=text_color)
+                or_val, og_val, ob_val = 255, 255, 255
+            outline_color_rgba = (or_val, og_val, ob_val, opacity)
             
-            # 如果需要斜体效果，则对文本图像进行变换
-            if italic:
-                # 实现斜体效果 - 通过水平错切变换
-                # 获取文本图像的尺寸
-                text_img_width, text_img_height = text_image.size
-                
-                # 定义错切因子（斜体倾斜程度）
-                skew_factor = 0.2
-                
-                # 创建一个新的图像来容纳变换后的文本
-                # 增加宽度以适应斜体效果
-                new_width = int(text_img_width + text_img_height * skew_factor)
-                skewed_image = Image.new('RGBA', (new_width, text_img_height), (0, 0, 0, 0))
-                
-                # 对每一行应用错切变换
-                for y in range(text_img_height):
-                    # 计算该行的错切偏移
-                    offset = int((text_img_height - y) * skew_factor)
-                    
-                    # 获取并粘贴该行像素
-                    line = text_image.crop((0, y, text_img_width, y + 1))
-                    skewed_image.paste(line, (offset, y))
+        # 阴影颜色
+        shadow_color = (0, 0, 0, opacity // 2) if settings['shadow'] else None
+        
+        # 字体目录中没有真实粗体/斜体字体文件时才模拟
+        fake_bold = bold and not self.font_resolver.has_native_style(font_family, bold, italic)
+        fake_italic = italic and not self.font_resolver.has_native_style(font_family, bold, italic)
+        
+        # 由特效引擎基于单张字形蒙版绘制文本、描边、粗体和阴影
+        bbox = self.font_resolver.measure_text(text, font_family, font_size, bold, italic)
+        # 特效宽度和边距按原图字号计算再换算，预览与导出中的文本框只差缩放比例
+        text_image, text_box = self.text_effects.render(text, font_obj, bbox, settings['font_size'], text_color,
+                                                        outline_color=outline_color_rgba, shadow_color=shadow_color,
+                                                        fake_bold=fake_bold, scale=scale)
+        
+        # 斜体错切（倾斜因子0.2）和旋转合并为一次仿射变换
+        skew_factor = 0.2 if fake_italic else 0.0
+        outline = self.text_effects.transformed_outline(text_image.size, skew_factor, settings['text_rotation'],
+                                                        text_box)
+        text_image = self.text_effects.skew_and_rotate(text_image, skew_factor, settings['text_rotation'])
+        
+        return text_image, outline
+    
+    def apply_watermark(self, image, scale=1.0, settings=None, in_place=False):
+        """应用水印到图像；scale为图像相对原图的缩放比例（预览代理使用），settings为水印设置快照，
+        in_place为True时直接修改传入的图像"""
+        if settings is None:
+            if not image or self.current_image_index < 0:
+                return image
                 
-                # 更新text_image为斜体变换后的图像
-                text_image = skewed_image
-            
-            # 获取旋转角度并应用旋转
-            text_rotation = watermark_vars['text_rotation'].get()
-            if text_rotation != 0:
-                text_image = text_image.rotate(text_rotation, expand=1)
+            # 获取当前图像的水印设置
+            settings = self.current_record().watermark
+        if not image:
+            return image
+        
+        # 将水印合并到图像上（只处理水印覆盖的区域）
+        return self.composite_sprites(image, self.get_watermark_placements(image.size, scale, settings), in_place)
+    
+    def get_watermark_placements(self, image_size, scale, settings):
+        """计算各水印的图像及其在图像中的位置，返回 [(类型, 水印图像, x, y, 轮廓多边形)]"""
+        if scale > self.MAX_SPRITE_SCALE:
+            factor = scale / self.MAX_SPRITE_SCALE
+            base_size = (max(1, round(image_size[0] / factor)), max(1, round(image_size[1] / factor)))
+            return [self.upscale_placement(placement, factor)
+                    for placement in self.get_watermark_placements(base_size, self.MAX_SPRITE_SCALE, settings)]
+        image_width, image_height = image_size
+        if scale != 1.0:
+            settings = self.scale_watermark_settings(settings, scale)
+        margin = round(10 * scale)
+        
+        # 需要叠加的水印列表
+        placements = []
+        
+        # 应用文本水印（如果设置了文本内容）
+        if settings['text']:
+            # 获取渲染好的文本水印（相同设置下直接复用缓存）
+            text_image, outline = self.get_text_sprite(settings, scale)
+            # 按文本框（不含特效扩展的区域）定位，预览和导出中的位置只差缩放比例
+            box_left, box_top, box_width, box_height = WatermarkGeometry.bounds(outline)
             
             # 计算文本水印位置
-            position = watermark_vars['position'].get()
-            margin = 10
+            position = settings['position']
             
             # 检查是否是自定义位置
             if position == "custom":
-                x = watermark_vars['custom_x'].get()
-                y = watermark_vars['custom_y'].get()
+                x = settings['custom_x']
+                y = settings['custom_y']
                 # 确保水印在图像范围内
-                x = max(0, min(x, image.size[0] - text_image.width))
-                y = max(0, min(y, image.size[1] - text_image.height))
+                x = max(0, min(x, image_width - box_width))
+                y = max(0, min(y, image_height - box_height))
             elif position == "top-left":
                 x, y = margin, margin
             elif position == "top-right":
-                x, y = image.size[0] - text_image.width - margin, margin
+                x, y = image_width - box_width - margin, margin
             elif position == "bottom-left":
-                x, y = margin, image.size[1] - text_image.height - margin
+                x, y = margin, image_height - box_height - margin
             elif position == "bottom-right":
-                x, y = image.size[0] - text_image.width - margin, image.size[1] - text_image.height - margin
+                x, y = image_width - box_width - margin, image_height - box_height - margin
             elif position == "center":
-                x, y = (image.size[0] - text_image.width) // 2, (image.size[1] - text_image.height) // 2
+                x, y = (image_width - box_width) // 2, (image_height - box_height) // 2
             else:
-                x, y = image.size[0] - text_image.width - margin, image.size[1] - text_image.height - margin
+                x, y = image_width - box_width - margin, image_height - box_height - margin
                 
-            # 将旋转后的文本水印粘贴到水印图层
-            watermark.paste(text_image, (x, y), text_image)
+            placements.append(('text', text_image, x - box_left, y - box_top, outline))
         
         # 应用图片水印（如果设置了图片路径）
-        if watermark_vars['image_path'].get():
+        if settings['image_path']:
             try:
-                # 加载图片水印
-                watermark_image = Image.open(watermark_vars['image_path'].get()).convert("RGBA")
-                
-                # 获取缩放比例
-                scale = watermark_vars['image_scale'].get()
-                if scale != 1.0:
-                    new_width = int(watermark_image.width * scale)
-                    new_height = int(watermark_image.height * scale)
-                    watermark_image = watermark_image.resize((new_width, new_height), Image.LANCZOS)
-                
-                # 获取透明度
-                image_opacity = watermark_vars['image_opacity'].get()
-                if image_opacity > 0:
-                    # 调整透明度（数值越高越透明）
-                    alpha = watermark_image.split()[-1]  # 获取alpha通道
-                    alpha = Image.eval(alpha, lambda x: int(x * (100 - image_opacity) / 100))
-                    watermark_image.putalpha(alpha)
-                
-                # 获取旋转角度并应用旋转
-                image_rotation = watermark_vars['image_rotation'].get()
-                if image_rotation != 0:
-                    watermark_image = watermark_image.rotate(image_rotation, expand=1)
+                # 从资源缓存获取缩放、调整透明度并旋转后的图片水印
+                watermark_image = self.watermark_assets.get_variant(
+                    settings['image_path'], settings['image_scale'],
+                    settings['image_opacity'], settings['image_rotation'])
+                # 旋转前的图片水印四角旋转后的位置
+                outline = WatermarkGeometry.rotated_outline(
+                    self.watermark_assets.get_scaled(settings['image_path'], settings['image_scale']).size,
+                    watermark_image.size, settings['image_rotation'])
+                box_left, box_top, box_width, box_height = WatermarkGeometry.bounds(outline)
                 
                 # 计算图片水印位置
-                image_position = watermark_vars['image_position'].get()
-                margin = 10
+                image_position = settings['image_position']
                 
                 # 检查是否是自定义位置
                 if image_position == "custom":
-                    x = watermark_vars['image_custom_x'].get()
-                    y = watermark_vars['image_custom_y'].get()
+                    x = settings['image_custom_x']
+                    y = settings['image_custom_y']
                     # 确保水印在图像范围内
-                    x = max(0, min(x, image.size[0] - watermark_image.width))
-                    y = max(0, min(y, image.size[1] - watermark_image.height))
+                    x = max(0, min(x, image_width - box_width))
+                    y = max(0, min(y, image_height - box_height))
                 elif image_position == "top-left":
                     x, y = margin, margin
                 elif image_position == "top-right":
-                    x, y = image.size[0] - watermark_image.width - margin, margin
+                    x, y = image_width - box_width - margin, margin
                 elif image_position == "bottom-left":
-                    x, y = margin, image.size[1] - watermark_image.height - margin
+                    x, y = margin, image_height - box_height - margin
                 elif image_position == "bottom-right":
-                    x, y = image.size[0] - watermark_image.width - margin, image.size[1] - watermark_image.height - margin
+                    x, y = image_width - box_width - margin, image_height - box_height - margin
                 elif image_position == "center":
-                    x, y = (image.size[0] - watermark_image.width) // 2, (image.size[1] - watermark_image.height) // 2
+                    x, y = (image_width - box_width) // 2, (image_height - box_height) // 2
                 else:
-                    x, y = image.size[0] - watermark_image.width - margin, image.size[1] - watermark_image.height - margin
+                    x, y = image_width - box_width - margin, image_height - box_height - margin
                 
-                # 将图片水印粘贴到水印图层
-                watermark.paste(watermark_image, (x, y), watermark_image)
+                placements.append(('image', watermark_image, x - box_left, y - box_top, outline))
             except Exception as e:
                 print(f"加载图片水印时出错: {e}")
         
-        # 将水印合并到图像上
-        watermarked_image = Image.alpha_composite(image.convert('RGBA'), watermark)
-        
-        return watermarked_image.convert('RGB') if image.mode == 'RGB' else watermarked_image
+        return placements
+    
+    def composite_sprites(self, image, placements, in_place=False):
+        """把水印逐个混合到图像上，只处理水印覆盖的区域；in_place表示图像归调用方私有，可直接修改"""
+        if not placements:
+            return image
+        if image.mode in ('RGB', 'RGBA'):
+            # 保持原图模式；图像为共享对象（缓存、当前处理结果）时才复制
+            result = image if in_place else image.copy()
+        else:
+            # 灰度、调色板等模式无法保留水印颜色，转换为RGBA
+            result = image.convert('RGBA')
+            
+        for _, sprite, x, y, _ in placements:
+            # 将水印区域裁剪到图像范围内
+            left, top = max(x, 0), max(y, 0)
+            right, bottom = min(x + sprite.width, result.width), min(y + sprite.height, result.height)
+            if left >= right or top >= bottom:
+                continue
+            if (left, top, right, bottom) != (x, y, x + sprite.width, y + sprite.height):
+                sprite = sprite.crop((left - x, top - y, right - x, bottom - y))
+                
+            if result.mode == 'RGB':
+                # 不透明底图上，以alpha为蒙版的粘贴就是标准的alpha混合
+                result.paste(sprite, (left, top), sprite)
+            else:
+                region = result.crop((left, top, right, bottom))
+                region.alpha_composite(sprite)
+                result.paste(region, (left, top))
+        return result
     
     def start_watermark_drag(self, event):
         """开始水印拖拽"""
         if self.current_image_index < 0:
             return
             
-        # 获取当前图像的水印设置
-        current_image = self.image_list[self.current_image_index]
-        watermark_vars = current_image['watermark_vars']
+        # 当前图像的水印变量
+        watermark_vars = self.watermark_vars
         
         # 检查点击位置以确定拖拽的是文本水印还是图片水印
         watermark_type = self.get_watermark_at_position(event)
@@ -859,32 +3416,11 @@ class ImageProcessorApp:
         elif watermark_type == "image":
             watermark_vars['image_position'].set("custom")
         
-        # 计算图像在画布中的位置和缩放比例
-        if self.processed_image:
-            # 获取画布尺寸
-            canvas_width = self.canvas.winfo_width()
-            canvas_height = self.canvas.winfo_height()
-            
-            # 如果画布尺寸为1（初始状态），使用预览框架的尺寸
-            if canvas_width <= 1 or canvas_height <= 1:
-                canvas_width = self.canvas.winfo_reqwidth()
-                canvas_height = self.canvas.winfo_reqheight()
-            
-            # 计算缩放比例
-            img_width, img_height = self.processed_image.size
-            scale_x = canvas_width / img_width
-            scale_y = canvas_height / img_height
-            scale = min(scale_x, scale_y, 1.0)  # 不放大图像
-            
-            # 计算图像在画布中的实际位置
-            display_width = int(img_width * scale)
-            display_height = int(img_height * scale)
-            offset_x = (canvas_width - display_width) // 2
-            offset_y = (canvas_height - display_height) // 2
-            
-            # 将鼠标坐标转换为图像坐标
-            image_x = int((event.x - offset_x) / scale)
-            image_y = int((event.y - offset_y) / scale)
+        # 使用当前预览的坐标变换把鼠标坐标转换为图像坐标
+        if self.original_image:
+            img_width, img_height = self.original_image.size
+            image_x, image_y = self.watermark_geometry.canvas_to_image(event.x, event.y)
+            image_x, image_y = int(image_x), int(image_y)
             
             # 确保坐标在图像范围内
             image_x = max(0, min(image_x, img_width - 1))
@@ -897,216 +3433,31 @@ class ImageProcessorApp:
             elif watermark_type == "image":
                 watermark_vars['image_custom_x'].set(image_x)
                 watermark_vars['image_custom_y'].set(image_y)
+        
+        # 以拖拽模式重新渲染：底图不含被拖动的水印，水印单独放在画布上
+        if watermark_type is not None:
+            self.request_render()
+        else:
+            # 没有点中水印时拖动平移放大的预览
+            self.start_pan(event)
     
     def get_watermark_at_position(self, event):
         """检查点击位置是否有水印，返回水印类型"""
-        if not self.processed_image:
+        if not self.original_image:
             return None
-            
-        # 获取当前图像的水印设置
-        current_image = self.image_list[self.current_image_index]
-        watermark_vars = current_image['watermark_vars']
-        
-        # 获取画布尺寸
-        canvas_width = self.canvas.winfo_width()
-        canvas_height = self.canvas.winfo_height()
-        
-        # 如果画布尺寸为1（初始状态），使用预览框架的尺寸
-        if canvas_width <= 1 or canvas_height <= 1:
-            canvas_width = self.canvas.winfo_reqwidth()
-            canvas_height = self.canvas.winfo_reqheight()
-        
-        # 计算缩放比例
-        img_width, img_height = self.processed_image.size
-        scale_x = canvas_width / img_width
-        scale_y = canvas_height / img_height
-        scale = min(scale_x, scale_y, 1.0)  # 不放大图像
-        
-        # 计算图像在画布中的实际位置
-        display_width = int(img_width * scale)
-        display_height = int(img_height * scale)
-        offset_x = (canvas_width - display_width) // 2
-        offset_y = (canvas_height - display_height) // 2
-        
-        # 将鼠标坐标转换为图像坐标
-        image_x = int((event.x - offset_x) / scale)
-        image_y = int((event.y - offset_y) / scale)
-        
-        # 检查是否有文本水印
-        text = watermark_vars['text'].get()
-        if text:
-            # 获取文本水印位置
-            position = watermark_vars['position'].get()
-            margin = 10
-            
-            # 获取字体设置
-            font_family = watermark_vars['font_family'].get()
-            font_size = watermark_vars['font_size'].get()
-            bold = watermark_vars['bold'].get()
-            italic = watermark_vars['italic'].get()
-            
-            # 创建临时绘图对象以计算文本尺寸
-            temp_image = Image.new('RGBA', (1, 1), (0, 0, 0, 0))
-            temp_draw = ImageDraw.Draw(temp_image)
-            
-            # 尝试加载字体
-            font_obj = None
-            try:
-                # 在Windows上尝试加载系统字体
-                if os.name == 'nt':  # Windows
-                    # 构造字体文件名
-                    font_filename = font_family.lower().replace(' ', '')
-                    # 根据粗体和斜体设置构造字体文件名
-                    if bold and italic:
-                        font_path = f"C:/Windows/Fonts/{font_filename}bi.ttf"
-                    elif bold:
-                        font_path = f"C:/Windows/Fonts/{font_filename}bd.ttf"  # bd instead of b
-                    elif italic:
-                        font_path = f"C:/Windows/Fonts/{font_filename}i.ttf"
-                    else:
-                        font_path = f"C:/Windows/Fonts/{font_filename}.ttf"
-                        
-                    if not os.path.exists(font_path):
-                        # 尝试其他可能的命名方式
-                        if bold and italic:
-                            font_path = f"C:/Windows/Fonts/{font_filename}-bolditalic.ttf"
-                        elif bold:
-                            font_path = f"C:/Windows/Fonts/{font_filename}-bold.ttf"
-                        elif italic:
-                            font_path = f"C:/Windows/Fonts/{font_filename}-italic.ttf"
-                            
-                    if os.path.exists(font_path):
-                        font_obj = ImageFont.truetype(font_path, font_size)
-            except Exception as e:
-                print(f"加载字体时出错: {e}")
-                pass
-                
-            # 如果上面的方法失败了，尝试使用 PIL 的默认字体处理方式
-            if font_obj is None:
-                try:
-                    # 尝试使用系统字体加载
-                    font_obj = ImageFont.truetype(font_family, font_size)
-                except:
-                    try:
-                        # 如果指定字体失败，尝试使用支持中文的默认字体
-                        # 在Windows上尝试使用支持中文的字体
-                        if os.name == 'nt':
-                            chinese_fonts = [
-                                "C:/Windows/Fonts/msyh.ttc",      # 微软雅黑
-                                "C:/Windows/Fonts/simhei.ttf",    # 黑体
-                                "C:/Windows/Fonts/simsun.ttc",    # 宋体
-                                "C:/Windows/Fonts/msgothic.ttc"   # 微软正黑体
-                            ]
-                            
-                            for font_path in chinese_fonts:
-                                if os.path.exists(font_path):
-                                    try:
-                                        font_obj = ImageFont.truetype(font_path, font_size)
-                                        break
-                                    except:
-                                        continue
-                                    
-                        # 如果还是失败，使用默认字体
-                        if font_obj is None:
-                            font_obj = ImageFont.load_default()
-                    except:
-                        font_obj = ImageFont.load_default()
-            
-            # 获取文本尺寸
-            bbox = temp_draw.textbbox((0, 0), text, font=font_obj)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-            
-            # 计算文本水印位置
-            if position == "custom":
-                x = watermark_vars['custom_x'].get()
-                y = watermark_vars['custom_y'].get()
-            elif position == "top-left":
-                x, y = margin, margin
-            elif position == "top-right":
-                x, y = img_width - text_width - margin, margin
-            elif position == "bottom-left":
-                x, y = margin, img_height - text_height - margin
-            elif position == "bottom-right":
-                x, y = img_width - text_width - margin, img_height - text_height - margin
-            elif position == "center":
-                x, y = (img_width - text_width) // 2, (img_height - text_height) // 2
-            else:
-                x, y = img_width - text_width - margin, img_height - text_height - margin
-            
-            # 检查点击位置是否在文本水印范围内
-            # 如果文本水印有旋转，则使用一个更宽松的检测范围
-            text_rotation = watermark_vars['text_rotation'].get()
-            if text_rotation != 0:
-                # 对于旋转的水印，我们使用一个更大的检测区域
-                buffer = 50  # 增加缓冲区以适应旋转后的水印
-                if x - buffer <= image_x <= x + text_width + buffer and y - buffer <= image_y <= y + text_height + buffer:
-                    return "text"
-            else:
-                # 未旋转的水印使用精确检测
-                if x <= image_x <= x + text_width and y <= image_y <= y + text_height:
-                    return "text"
-        
-        # 检查是否有图片水印
-        if watermark_vars['image_path'].get():
-            try:
-                # 获取图片水印位置
-                image_position = watermark_vars['image_position'].get()
-                margin = 10
-                
-                # 加载图片水印以获取尺寸
-                watermark_image = Image.open(watermark_vars['image_path'].get()).convert("RGBA")
-                
-                # 获取缩放比例
-                scale = watermark_vars['image_scale'].get()
-                if scale != 1.0:
-                    new_width = int(watermark_image.width * scale)
-                    new_height = int(watermark_image.height * scale)
-                    watermark_image = watermark_image.resize((new_width, new_height), Image.LANCZOS)
-                
-                # 计算图片水印位置
-                if image_position == "custom":
-                    x = watermark_vars['image_custom_x'].get()
-                    y = watermark_vars['image_custom_y'].get()
-                elif image_position == "top-left":
-                    x, y = margin, margin
-                elif image_position == "top-right":
-                    x, y = img_width - watermark_image.width - margin, margin
-                elif image_position == "bottom-left":
-                    x, y = margin, img_height - watermark_image.height - margin
-                elif image_position == "bottom-right":
-                    x, y = img_width - watermark_image.width - margin, img_height - watermark_image.height - margin
-                elif image_position == "center":
-                    x, y = (img_width - watermark_image.width) // 2, (img_height - watermark_image.height) // 2
-                else:
-                    x, y = img_width - watermark_image.width - margin, img_height - watermark_image.height - margin
-                
-                # 检查点击位置是否在图片水印范围内
-                # 如果图片水印有旋转，则使用一个更宽松的检测范围
-                image_rotation = watermark_vars['image_rotation'].get()
-                if image_rotation != 0:
-                    # 对于旋转的水印，我们使用一个更大的检测区域
-                    buffer = 50  # 增加缓冲区以适应旋转后的水印
-                    if x - buffer <= image_x <= x + watermark_image.width + buffer and y - buffer <= image_y <= y + watermark_image.height + buffer:
-                        return "image"
-                else:
-                    # 未旋转的水印使用精确检测
-                    if x <= image_x <= x + watermark_image.width and y <= image_y <= y + watermark_image.height:
-                        return "image"
-            except Exception as e:
-                print(f"检查图片水印时出错: {e}")
-        
-        # 如果没有水印或点击位置不在水印上，返回None
-        return None
+        # 按渲染时发布的精确轮廓检测（重叠时返回上层的水印）
+        return self.watermark_geometry.hit_test(event.x, event.y)
     
     def on_watermark_drag(self, event):
         """水印拖拽中"""
+        if self.pan_data is not None:
+            self.on_pan(event)
+            return
         if not self.watermark_drag_data["dragging"] or self.current_image_index < 0:
             return
             
-        # 获取当前图像的水印设置
-        current_image = self.image_list[self.current_image_index]
-        watermark_vars = current_image['watermark_vars']
+        # 当前图像的水印变量
+        watermark_vars = self.watermark_vars
         
         # 获取拖拽类型
         watermark_type = self.watermark_drag_data.get("type", None)
@@ -1117,32 +3468,11 @@ class ImageProcessorApp:
         elif watermark_type == "image":
             watermark_vars['image_position'].set("custom")
         
-        # 计算图像在画布中的位置和缩放比例
-        if self.processed_image:
-            # 获取画布尺寸
-            canvas_width = self.canvas.winfo_width()
-            canvas_height = self.canvas.winfo_height()
-            
-            # 如果画布尺寸为1（初始状态），使用预览框架的尺寸
-            if canvas_width <= 1 or canvas_height <= 1:
-                canvas_width = self.canvas.winfo_reqwidth()
-                canvas_height = self.canvas.winfo_reqheight()
-            
-            # 计算缩放比例
-            img_width, img_height = self.processed_image.size
-            scale_x = canvas_width / img_width
-            scale_y = canvas_height / img_height
-            scale = min(scale_x, scale_y, 1.0)  # 不放大图像
-            
-            # 计算图像在画布中的实际位置
-            display_width = int(img_width * scale)
-            display_height = int(img_height * scale)
-            offset_x = (canvas_width - display_width) // 2
-            offset_y = (canvas_height - display_height) // 2
-            
-            # 将鼠标坐标转换为图像坐标
-            image_x = int((event.x - offset_x) / scale)
-            image_y = int((event.y - offset_y) / scale)
+        # 使用当前预览的坐标变换把鼠标坐标转换为图像坐标
+        if self.original_image:
+            img_width, img_height = self.original_image.size
+            image_x, image_y = self.watermark_geometry.canvas_to_image(event.x, event.y)
+            image_x, image_y = int(image_x), int(image_y)
             
             # 确保坐标在图像范围内
             image_x = max(0, min(image_x, img_width - 1))
@@ -1156,13 +3486,37 @@ class ImageProcessorApp:
                 watermark_vars['image_custom_x'].set(image_x)
                 watermark_vars['image_custom_y'].set(image_y)
         
-        # 更新预览
-        self.display_image_on_canvas()
+        # 只移动画布上的水印图像，不重新合成预览
+        self.move_drag_sprite()
+    
+    def move_drag_sprite(self):
+        """把拖拽中的水印图像移动到当前水印位置"""
+        item = self.watermark_drag_data.get("sprite_item")
+        if item is None:
+            return
+        watermark_vars = self.watermark_vars
+        if self.watermark_drag_data["type"] == "text":
+            x, y = watermark_vars['custom_x'].get(), watermark_vars['custom_y'].get()
+        else:
+            x, y = watermark_vars['image_custom_x'].get(), watermark_vars['image_custom_y'].get()
+        
+        # 与合成时相同：按预览比例缩放，文本框限制在图像范围内，再换算为水印图像左上角的位置
+        geometry = self.watermark_geometry
+        box_left, box_top, box_width, box_height = self.watermark_drag_data["sprite_box"]
+        x = max(0, min(int(x * geometry.scale), self.preview_size[0] - box_width)) - box_left
+        y = max(0, min(int(y * geometry.scale), self.preview_size[1] - box_height)) - box_top
+        geometry.move(self.watermark_drag_data["type"], x, y)
+        self.canvas.coords(item, geometry.offset[0] + x, geometry.offset[1] + y)
     
     def end_watermark_drag(self, event):
         """结束水印拖拽"""
+        self.end_pan(event)
+        was_dragging = self.watermark_drag_data["dragging"] and self.watermark_drag_data["type"] is not None
         self.watermark_drag_data["dragging"] = False
         self.watermark_drag_data["type"] = None
+        # 拖拽结束后重新合成一次完整预览
+        if was_dragging:
+            self.request_render()
     
     def show_watermark_settings(self):
         """显示水印设置对话框"""
@@ -1170,35 +3524,8 @@ class ImageProcessorApp:
             messagebox.showwarning("警告", "请先选择一张图像")
             return
             
-        # 获取当前图像的水印设置
-        current_image = self.image_list[self.current_image_index]
-        if 'watermark_vars' not in current_image:
-            # 如果当前图像没有水印设置，创建一个新的
-            watermark_vars = {}
-            for key, var in self.default_watermark_vars.items():
-                if isinstance(var, tk.StringVar):
-                    watermark_vars[key] = tk.StringVar(value=var.get())
-                elif isinstance(var, tk.BooleanVar):
-                    watermark_vars[key] = tk.BooleanVar(value=var.get())
-                elif isinstance(var, tk.IntVar):
-                    watermark_vars[key] = tk.IntVar(value=var.get())
-                elif isinstance(var, tk.DoubleVar):
-                    watermark_vars[key] = tk.DoubleVar(value=var.get())
-            current_image['watermark_vars'] = watermark_vars
-        else:
-            # 确保所有水印变量都存在（特别是新增的图片水印相关变量）
-            watermark_vars = current_image['watermark_vars']
-            # 检查并添加缺失的变量
-            for key, var in self.default_watermark_vars.items():
-                if key not in watermark_vars:
-                    if isinstance(var, tk.StringVar):
-                        watermark_vars[key] = tk.StringVar(value=var.get())
-                    elif isinstance(var, tk.BooleanVar):
-                        watermark_vars[key] = tk.BooleanVar(value=var.get())
-                    elif isinstance(var, tk.IntVar):
-                        watermark_vars[key] = tk.IntVar(value=var.get())
-                    elif isinstance(var, tk.DoubleVar):
-                        watermark_vars[key] = tk.DoubleVar(value=var.get())
+        # 当前图像的水印变量
+        watermark_vars = self.watermark_vars
         
         # 创建水印设置窗口
         watermark_dialog = tk.Toplevel(self.root)
@@ -1265,13 +3592,29 @@ class ImageProcessorApp:
                                  values=SYSTEM_FONTS, state="readonly")
         font_combo.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
         
+        # 字体目录就绪后用索引中的字体族填充下拉框
+        def fill_font_combo():
+            if not font_combo.winfo_exists():
+                return
+            if not self.font_catalog.ready.is_set():
+                font_combo.after(200, fill_font_combo)
+                return
+            families = self.font_catalog.families()
+            if families:
+                current_family = watermark_vars['font_family'].get()
+                if current_family not in families:
+                    families.insert(0, current_family)
+                font_combo['values'] = families
+                
+        fill_font_combo()
+        
         # 字号
         size_frame = ttk.Frame(font_frame)
         size_frame.pack(fill=tk.X, pady=(0, 5))
         
         ttk.Label(size_frame, text="字号:").pack(side=tk.LEFT)
         size_spinbox = ttk.Spinbox(size_frame, from_=8, to=100, textvariable=watermark_vars['font_size'], 
-                                  width=10, command=self.display_image_on_canvas)
+                                  width=10, command=self.request_render)
         size_spinbox.pack(side=tk.LEFT, padx=(5, 0))
         
         # 字体样式
@@ -1279,9 +3622,9 @@ class ImageProcessorApp:
         style_frame.pack(fill=tk.X, pady=(0, 5))
         
         ttk.Checkbutton(style_frame, text="粗体", variable=watermark_vars['bold'], 
-                       command=self.display_image_on_canvas).pack(side=tk.LEFT)
+                       command=self.request_render).pack(side=tk.LEFT)
         ttk.Checkbutton(style_frame, text="斜体", variable=watermark_vars['italic'], 
-                       command=self.display_image_on_canvas).pack(side=tk.LEFT, padx=(10, 0))
+                       command=self.request_render).pack(side=tk.LEFT, padx=(10, 0))
         
         # 颜色设置
         color_frame = ttk.LabelFrame(scrollable_frame, text="颜色设置", padding=10)
@@ -1297,7 +3640,7 @@ class ImageProcessorApp:
             color = colorchooser.askcolor(color=watermark_vars['color'].get(), title="选择文本颜色")
             if color[1]:  # 如果用户选择了颜色
                 watermark_vars['color'].set(color[1])
-                self.display_image_on_canvas()
+                self.request_render()
                 
         color_button = tk.Button(text_color_frame, text="选择颜色", command=choose_text_color)
         color_button.pack(side=tk.LEFT, padx=(5, 0))
@@ -1313,7 +3656,7 @@ class ImageProcessorApp:
         ttk.Label(opacity_frame, text="透明度:").pack(side=tk.LEFT)
         opacity_scale = ttk.Scale(opacity_frame, from_=0, to=100, 
                                  variable=watermark_vars['opacity'], orient=tk.HORIZONTAL,
-                                 command=lambda v: self.display_image_on_canvas())
+                                 command=self.request_render)
         opacity_scale.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         
         # 创建一个显示整数透明度值的标签
@@ -1354,20 +3697,20 @@ class ImageProcessorApp:
         
         # 阴影
         ttk.Checkbutton(effect_frame, text="阴影", variable=watermark_vars['shadow'], 
-                       command=self.display_image_on_canvas).pack(anchor=tk.W)
+                       command=self.request_render).pack(anchor=tk.W)
         
         # 描边
         outline_frame = ttk.Frame(effect_frame)
         outline_frame.pack(fill=tk.X, pady=(5, 0))
         
         ttk.Checkbutton(outline_frame, text="描边", variable=watermark_vars['outline'], 
-                       command=self.display_image_on_canvas).pack(side=tk.LEFT)
+                       command=self.request_render).pack(side=tk.LEFT)
         
         def choose_outline_color():
             color = colorchooser.askcolor(color=watermark_vars['outline_color'].get(), title="选择描边颜色")
             if color[1]:  # 如果用户选择了颜色
                 watermark_vars['outline_color'].set(color[1])
-                self.display_image_on_canvas()
+                self.request_render()
                 
         outline_color_button = tk.Button(outline_frame, text="描边颜色", command=choose_outline_color)
         outline_color_button.pack(side=tk.LEFT, padx=(10, 0))
@@ -1397,7 +3740,7 @@ class ImageProcessorApp:
             )
             if file_path:
                 watermark_vars['image_path'].set(file_path)
-                self.display_image_on_canvas()
+                self.request_render()
                 
         image_path_frame = ttk.Frame(image_select_frame)
         image_path_frame.pack(fill=tk.X, pady=(5, 0))
@@ -1415,7 +3758,7 @@ class ImageProcessorApp:
         ttk.Label(image_opacity_frame, text="透明度:").pack(side=tk.LEFT)
         image_opacity_scale = ttk.Scale(image_opacity_frame, from_=0, to=100,
                                        variable=watermark_vars['image_opacity'], orient=tk.HORIZONTAL,
-                                       command=lambda v: self.display_image_on_canvas())
+                                       command=self.request_render)
         image_opacity_scale.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         
         # 创建一个显示整数透明度值的标签
@@ -1437,7 +3780,7 @@ class ImageProcessorApp:
         ttk.Label(image_scale_frame, text="缩放比例:").pack(side=tk.LEFT)
         image_scale_scale = ttk.Scale(image_scale_frame, from_=0.1, to=3.0, 
                                      variable=watermark_vars['image_scale'], orient=tk.HORIZONTAL,
-                                     command=lambda v: self.display_image_on_canvas())
+                                     command=self.request_render)
         image_scale_scale.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         
         # 创建一个显示缩放比例值的标签
@@ -1489,6 +3832,10 @@ class ImageProcessorApp:
         position_values = [text for text, key in positions]
         position_var = watermark_vars['position']
         
+        def show_position(combo, var):
+            """组合框显示位置变量对应的文字（切换图像或加载模板后变量会改变）"""
+            combo.set(next((text for text, key in positions if key == var.get()), "右下角"))
+        
         position_combo_frame = ttk.Frame(position_frame)
         position_combo_frame.pack(fill=tk.X, pady=(0, 5))
         
@@ -1500,14 +3847,7 @@ class ImageProcessorApp:
                            lambda e: position_var.set([key for text, key in positions if text == position_combo.get()][0]))
         
         # 初始化位置组合框
-        try:
-            current_position = position_var.get()
-            for text, key in positions:
-                if key == current_position:
-                    position_combo.set(text)
-                    break
-        except:
-            position_combo.set("右下角")
+        show_position(position_combo, position_var)
             
         # 图片水印位置设置
         image_position_frame = ttk.LabelFrame(scrollable_frame, text="图片水印位置设置", padding=10)
@@ -1526,14 +3866,7 @@ class ImageProcessorApp:
                            lambda e: image_position_var.set([key for text, key in positions if text == image_position_combo.get()][0]))
         
         # 初始化图片水印位置组合框
-        try:
-            current_image_position = image_position_var.get()
-            for text, key in positions:
-                if key == current_image_position:
-                    image_position_combo.set(text)
-                    break
-        except:
-            image_position_combo.set("右下角")
+        show_position(image_position_combo, image_position_var)
         # 模板管理
         template_frame = ttk.LabelFrame(scrollable_frame, text="模板管理", padding=10)
         template_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -1553,17 +3886,8 @@ class ImageProcessorApp:
                 messagebox.showwarning("警告", "请输入模板名称")
                 return
                 
-            # 收集当前水印设置
-            settings = {}
-            for key, var in watermark_vars.items():
-                if isinstance(var, tk.StringVar):
-                    settings[key] = var.get()
-                elif isinstance(var, tk.BooleanVar):
-                    settings[key] = var.get()
-                elif isinstance(var, tk.IntVar):
-                    settings[key] = var.get()
-                elif isinstance(var, tk.DoubleVar):
-                    settings[key] = var.get()
+            # 当前图像的水印设置
+            settings = dict(self.current_record().watermark)
             
             # 检查是否已存在同名模板
             if name in self.template_manager.get_template_names():
@@ -1616,16 +3940,7 @@ class ImageProcessorApp:
                             var.set(value)
                         elif isinstance(var, tk.DoubleVar):
                             var.set(value)
-                self.display_image_on_canvas()
-                # 更新位置组合框
-                try:
-                    current_position = position_var.get()
-                    for text, key in positions:
-                        if key == current_position:
-                            position_combo.set(text)
-                            break
-                except:
-                    position_combo.set("右下角")
+                self.request_render()
                 messagebox.showinfo("成功", f"模板 '{name}' 已加载")
             else:
                 messagebox.showerror("错误", "无法加载模板")
@@ -1659,32 +3974,48 @@ class ImageProcessorApp:
         # 确保初始时正确设置滚动区域
         watermark_dialog.after(100, lambda: canvas.configure(scrollregion=canvas.bbox("all")))
         
-        # 绑定实时预览更新
-        def update_preview(*args):
-            self.display_image_on_canvas()
-            
-        # 为所有相关变量添加跟踪
-        watermark_vars['text'].trace('w', update_preview)
-        watermark_vars['font_family'].trace('w', update_preview)
-        watermark_vars['font_size'].trace('w', update_preview)
-        watermark_vars['bold'].trace('w', update_preview)
-        watermark_vars['italic'].trace('w', update_preview)
-        watermark_vars['color'].trace('w', update_preview)
-        watermark_vars['opacity'].trace('w', update_preview)
-        watermark_vars['shadow'].trace('w', update_preview)
-        watermark_vars['outline'].trace('w', update_preview)
-        watermark_vars['outline_color'].trace('w', update_preview)
-        watermark_vars['position'].trace('w', update_preview)
-        watermark_vars['text_rotation'].trace('w', update_preview)
-        watermark_vars['image_path'].trace('w', update_preview)
-        watermark_vars['image_opacity'].trace('w', update_preview)
-        watermark_vars['image_scale'].trace('w', update_preview)
-        watermark_vars['image_position'].trace('w', update_preview)
-        watermark_vars['image_rotation'].trace('w', update_preview)
+        # 绑定实时预览更新：跟踪由对话框持有，关闭对话框时移除，避免重复打开后重复渲染
+        trace_subscriptions = []
+        for key in ('text', 'font_family', 'font_size', 'bold', 'italic', 'color', 'opacity',
+                    'shadow', 'outline', 'outline_color', 'position', 'text_rotation',
+                    'image_path', 'image_opacity', 'image_scale', 'image_position', 'image_rotation'):
+            trace_name = watermark_vars[key].trace_add('write', self.request_render)
+            trace_subscriptions.append((watermark_vars[key], trace_name))
+        # 位置组合框跟随位置变量（切换图像、加载模板）
+        for combo, var in ((position_combo, position_var), (image_position_combo, image_position_var)):
+            trace_name = var.trace_add('write', lambda *args, combo=combo, var=var: show_position(combo, var))
+            trace_subscriptions.append((var, trace_name))
+            
+        def remove_traces(event):
+            if event.widget is watermark_dialog:
+                for var, trace_name in trace_subscriptions:
+                    try:
+                        var.trace_remove('write', trace_name)
+                    except tk.TclError:
+                        pass
+                trace_subscriptions.clear()
+                
+        watermark_dialog.bind("<Destroy>", remove_traces, add="+")
+    
+    @staticmethod
+    def source_extension(name, image_format):
+        """按原格式导出时使用的 (扩展名, 格式)：导入时按文件头识别的图像，文件名的扩展名可能缺失或与实际格式不符，
+        此时按实际格式选择扩展名"""
+        if image_format == 'MPO':
+            # 相机拍摄的多图JPEG由Pillow识别为MPO，按普通JPEG保存
+            image_format = 'JPEG'
+        extensions = Image.registered_extensions()
+        ext = os.path.splitext(name)[1]
+        if image_format is None or extensions.get(ext.lower()) == image_format:
+            return ext, image_format
+        for candidate in FolderScanner.IMAGE_EXTENSIONS + tuple(extensions):
+            if extensions.get(candidate) == image_format:
+                return candidate, image_format
+        return ext, image_format
     
     def export_image(self):
         """导出图像"""
-        if self.processed_image:
+        if self.original_image:
             # 创建导出对话框
             export_dialog = tk.Toplevel(self.root)
             export_dialog.title("导出图像")
@@ -1769,9 +4100,10 @@ class ImageProcessorApp:
             format_frame = ttk.LabelFrame(scrollable_frame, text="导出格式", padding=10)
             format_frame.pack(fill=tk.X, padx=5, pady=5)
             
-            # 获取当前图像的扩展名
-            current_image = self.image_list[self.current_image_index]
-            original_ext = os.path.splitext(current_image['name'])[1].lower()
+            # 获取当前图像实际格式对应的扩展名
+            current_image = self.current_record()
+            source_ext, source_format = self.source_extension(current_image.name, self.original_image.format)
+            original_ext = source_ext.lower()
             
             ttk.Radiobutton(format_frame, text=f"保持原格式 ({original_ext.upper()[1:]})", 
                            variable=export_options['export_format'], value='same').pack(anchor=tk.W)
@@ -1895,9 +4227,9 @@ class ImageProcessorApp:
             def do_export():
                 try:
                     # 获取当前图像的目录和文件名
-                    current_image = self.image_list[self.current_image_index]
-                    original_dir = os.path.dirname(current_image['path'])
-                    original_name = os.path.splitext(current_image['name'])[0]
+                    current_image = self.current_record()
+                    original_dir = os.path.dirname(current_image.path)
+                    original_name = os.path.splitext(current_image.name)[0]
                     
                     # 根据命名规则确定文件名
                     naming_rule = export_options['naming_rule'].get()
@@ -1910,8 +4242,10 @@ class ImageProcessorApp:
                     
                     # 确定导出格式和扩展名
                     export_format = export_options['export_format'].get()
+                    save_kwargs = {}
                     if export_format == 'same':
-                        ext = os.path.splitext(current_image['name'])[1]
+                        ext = source_ext
+                        save_kwargs['format'] = source_format
                     elif export_format == 'jpeg':
                         ext = '.jpg'
                     else:  # png
@@ -1933,14 +4267,15 @@ class ImageProcessorApp:
                     export_path = os.path.join(export_dir, new_name + ext)
                     
                     # 处理JPEG质量和其他保存参数
-                    save_kwargs = {}
                     if ext.lower() in ['.jpg', '.jpeg']:
                         save_kwargs['quality'] = export_options['jpeg_quality'].get()
                         save_kwargs['optimize'] = True
                     
                     # 保存图像
                     # 检查是否需要转换图像模式（JPEG不支持RGBA模式）
-                    image_to_save = self.processed_image
+                    # 只读取一次：每次读取都会运行全分辨率编辑流水线（大图的结果不进缓存）
+                    processed = self.processed_image
+                    image_to_save = processed
                     
                     # 处理尺寸调整
                     resize_option = export_options['resize_option'].get()
@@ -1964,7 +4299,7 @@ class ImageProcessorApp:
                             pass  # 如果输入无效，保持原尺寸
                     
                     # 应用水印（使用当前图像的水印设置）
-                    image_to_save = self.apply_watermark(image_to_save)
+                    image_to_save = self.apply_watermark(image_to_save, in_place=image_to_save is not processed)
                     
                     if ext.lower() in ['.jpg', '.jpeg'] and image_to_save.mode in ('RGBA', 'LA', 'P'):
                         # 创建白色背景
@@ -2006,7 +4341,8 @@ class ImageProcessorApp:
                             save_kwargs['optimize'] = True
                         
                         # 检查是否需要转换图像模式（JPEG不支持RGBA模式）
-                        image_to_save = self.processed_image
+                        processed = self.processed_image
+                        image_to_save = processed
                         
                         # 处理尺寸调整
                         resize_option = export_options['resize_option'].get()
@@ -2030,7 +4366,7 @@ class ImageProcessorApp:
                                 pass  # 如果输入无效，保持原尺寸
                         
                         # 应用水印（使用当前图像的水印设置）
-                        image_to_save = self.apply_watermark(image_to_save)
+                        image_to_save = self.apply_watermark(image_to_save, in_place=image_to_save is not processed)
                         
                         if file_path.lower().endswith(('.jpg', '.jpeg')) and image_to_save.mode in ('RGBA', 'LA', 'P'):
                             # 创建白色背景
@@ -2078,25 +4414,9 @@ class ImageProcessorApp:
             import shlex
             file_paths = shlex.split(event.data)
             
-            # 过滤出图像文件
-            image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff')
-            image_files = []
-            
-            for file_path in file_paths:
-                # 移除可能的引号
-                file_path = file_path.strip('"')
-                if os.path.isfile(file_path) and file_path.lower().endswith(image_extensions):
-                    image_files.append(file_path)
-                elif os.path.isdir(file_path):
-                    # 如果是目录，则导入目录中的所有图像
-                    for subfile in os.listdir(file_path):
-                        if subfile.lower().endswith(image_extensions):
-                            image_files.append(os.path.join(file_path, subfile))
-            
-            if image_files:
-                self.add_images_to_list(image_files)
-            else:
-                messagebox.showinfo("提示", "拖拽的文件中没有找到支持的图像文件")
+            # 移除可能的引号；文件夹递归扫描，文件按扩展名或文件头过滤出图像
+            file_paths = [file_path.strip('"') for file_path in file_paths]
+            self.import_paths(file_paths, "拖拽的文件中没有找到支持的图像文件")
 
 
 def main():
@@ -2108,6 +4428,9 @@ def main():
     
     app = ImageProcessorApp(root)
     root.mainloop()
+    app.render_worker.shutdown()
+    app.thumbnail_loader.shutdown()
+    app.filter_executor.shutdown()
 
 
 if __name__ == "__main__":